@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""Compare the throughput of the csvcat example with the version in
+the Python Magazine article.
+"""
+
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[0:0] = [ROOT, os.path.join(ROOT, 'examples')]
+
+import commandlineapp
+import csvcat
+
+article = imp.load_source(
+    'article_csvcat',
+    os.path.join(ROOT, 'docs', 'source', 'PyMagArticle', 'Listing2.py'))
+
+
+class csvcat_benchmark(commandlineapp.CommandLineApp):
+    """Time concatenating generated csv files.
+    """
+
+    _app_name = 'csvcat_benchmark'
+
+    files = 4
+    def option_handler_files(self, num):
+        """Number of input files to generate.  Defaults to 4.
+        """
+        self.files = int(num)
+        return
+
+    rows = 250000
+    def option_handler_rows(self, num):
+        """Number of rows in each input file.  Defaults to 250000.
+        """
+        self.rows = int(num)
+        return
+
+    jobs = 4
+    def option_handler_jobs(self, num):
+        """Number of files to read in parallel.  Defaults to 4.
+        """
+        self.jobs = int(num)
+        return
+
+    def make_input_files(self, dirname):
+        "Create the input files and return their names."
+        filenames = []
+        for i in range(self.files):
+            filename = os.path.join(dirname, 'input%d.csv' % i)
+            f = open(filename, 'wb')
+            try:
+                f.write('id,name,quantity,price,date,comment\r\n')
+                for row in xrange(self.rows):
+                    f.write('%d,item %d,%d,%d.%02d,2007-11-%02d,"a, b"\r\n' %
+                            (row, row % 1000, row % 50, row % 100, row % 100,
+                             row % 28 + 1))
+            finally:
+                f.close()
+            filenames.append(filename)
+        return filenames
+
+    def time_app(self, app_class, args):
+        """Run the app with its output sent to /dev/null and return the
+        elapsed time.
+        """
+        if app_class is article.csvcat:
+            # The article version adds to a list shared by the class.
+            app_class.columns = []
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'wb')
+        try:
+            app = app_class(args)
+            app.force_exit = False
+            start = time.time()
+            app.run()
+            elapsed = time.time() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return elapsed
+
+    def main(self):
+        tempdir = tempfile.mkdtemp(prefix='csvcat-benchmark-')
+        try:
+            filenames = self.make_input_files(tempdir)
+            size = sum([ os.path.getsize(name) for name in filenames ])
+            jobs = ['--jobs', str(self.jobs)]
+            cases = [
+                ('article', article.csvcat, ['--skip-headers']),
+                ('csvcat', csvcat.csvcat, ['--skip-headers']),
+                ('csvcat --jobs', csvcat.csvcat, ['--skip-headers'] + jobs),
+                ('article --columns', article.csvcat,
+                 ['--skip-headers', '--columns', '0,2,3']),
+                ('csvcat --columns', csvcat.csvcat,
+                 ['--skip-headers', '--columns', '0,2,3']),
+                ('csvcat --columns --jobs', csvcat.csvcat,
+                 ['--skip-headers', '--columns', '0,2,3'] + jobs),
+                ]
+            print '%d files, %.1f MB' % (len(filenames), size / 1048576.0)
+            print
+            print '%-26s %8s %8s' % ('case', 'seconds', 'MB/s')
+            for name, app_class, args in cases:
+                elapsed = self.time_app(app_class, args + filenames)
+                print '%-26s %8.2f %8.1f' % (name, elapsed,
+                                             size / 1048576.0 / elapsed)
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
+if __name__ == '__main__':
+    csvcat_benchmark().run()
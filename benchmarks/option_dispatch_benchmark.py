@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Compare calling option handlers through the invokers made by
+OptionDef.bind() with looking up the handler for every call.
+"""
+
+import os
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import commandlineapp
+
+
+def lookup_and_invoke(opt_def, app, arg):
+    "Call the handler the way OptionDef.invoke() did before bind()."
+    method = getattr(app, opt_def.method_name)
+    if opt_def.arg_name:
+        if opt_def.is_variable:
+            result = method(*arg.split(opt_def.SPLIT_PARAM_CHAR))
+        else:
+            result = method(arg)
+    else:
+        result = method()
+    if opt_def.is_coroutine:
+        app._run_coroutine(result)
+    return
+
+
+class dispatch_app(commandlineapp.CommandLineApp):
+    """Application with one option of each kind.
+    """
+
+    force_exit = False
+
+    def option_handler_flag(self):
+        "Takes no argument."
+        return
+
+    def option_handler_name(self, name):
+        "Takes one argument."
+        return
+
+    def option_handler_items(self, *item):
+        "Takes a list of arguments."
+        return
+
+    def main(self):
+        return
+
+
+class option_dispatch_benchmark(commandlineapp.CommandLineApp):
+    """Time dispatching options to their handlers.
+    """
+
+    _app_name = 'option_dispatch_benchmark'
+
+    calls = 1000000
+    def option_handler_calls(self, num):
+        """Number of calls to time for each kind of option.
+        Defaults to 1000000.
+        """
+        self.calls = int(num)
+        return
+
+    commands = 2000
+    def option_handler_commands(self, num):
+        """Number of command lines to run with run_batch().
+        Defaults to 2000.
+        """
+        self.commands = int(num)
+        return
+
+    def main(self):
+        app = dispatch_app([])
+        options = dict([ (o.option_name, o) for o in app.supported_options ])
+        print '%-10s %12s %12s %8s' % ('option', 'lookup ns', 'bound ns',
+                                       'speedup')
+        for name, arg in [('flag', ''), ('name', 'value'), ('items', 'a,b,c')]:
+            opt_def = options[name]
+            invoker = app._get_option_invoker(opt_def)
+            lookup = min(timeit.repeat(
+                lambda: lookup_and_invoke(opt_def, app, arg),
+                repeat=3, number=self.calls))
+            bound = min(timeit.repeat(lambda: invoker(arg),
+                                      repeat=3, number=self.calls))
+            print '%-10s %12.1f %12.1f %7.2fx' % (
+                name, lookup * 1e9 / self.calls, bound * 1e9 / self.calls,
+                lookup / bound)
+
+        command_line = ['--flag', '--name=value', '--items=a,b,c']
+        start = timeit.default_timer()
+        for result in dispatch_app.run_batch([command_line] * self.commands):
+            pass
+        elapsed = timeit.default_timer() - start
+        print
+        print 'run_batch: %.1f commands/s' % (self.commands / elapsed)
+        return
+
+if __name__ == '__main__':
+    option_dispatch_benchmark().run()
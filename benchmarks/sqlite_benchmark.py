@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""Time loading and showing a large log table with SQLiteAppBase.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[0:0] = [ROOT, os.path.join(ROOT, 'examples')]
+
+import commandlineapp
+import indexlog
+import showlog
+
+FAST_PRAGMAS = (('journal_mode', 'WAL'),
+                ('synchronous', 'NORMAL'),
+                ('cache_size', -64000),
+                )
+
+
+def generate_log(rows):
+    "Generate rows for the log table."
+    for i in xrange(rows):
+        yield ('Fri Nov  2 10:%02d:%02d 2007' % (i // 60 % 60, i % 60),
+               'message %d from worker %d' % (i, i % 17))
+
+
+class rowinsert(commandlineapp.SQLiteAppBase):
+    "Insert the log one row at a time, like the article's updatelog."
+
+    rows = 0
+    def take_action(self):
+        self.cursor.execute("CREATE TABLE log (date text, message text)")
+        for row in generate_log(self.rows):
+            self.cursor.execute(
+                "INSERT INTO log (date, message) VALUES (?, ?)", row)
+        return 0
+
+
+class bulkinsert(rowinsert):
+    "Insert the log in batches with insert_many()."
+
+    def take_action(self):
+        self.cursor.execute("CREATE TABLE log (date text, message text)")
+        self.insert_many("INSERT INTO log (date, message) VALUES (?, ?)",
+                         generate_log(self.rows))
+        return 0
+
+
+class printlog(commandlineapp.SQLiteAppBase):
+    "Print the log one row at a time, like the article's showlog."
+
+    def take_action(self):
+        for row in self.cursor.execute("SELECT * FROM log;"):
+            print '%-30s %s' % row
+        return 0
+
+
+class sqlite_benchmark(commandlineapp.CommandLineApp):
+    """Time loading and showing a large log table.
+    """
+
+    _app_name = 'sqlite_benchmark'
+
+    rows = 1000000
+    def option_handler_rows(self, num):
+        """Number of rows in the log table.  Defaults to 1000000.
+        """
+        self.rows = int(num)
+        return
+
+    queries = 200
+    def option_handler_queries(self, num):
+        """Number of short commands run in one batch.  Defaults to 200.
+        """
+        self.queries = int(num)
+        return
+
+    searches = 20
+    def option_handler_searches(self, num):
+        """Number of showlog --message searches to time.  Defaults to 20.
+        """
+        self.searches = int(num)
+        return
+
+    def time_app(self, app_class, args, **attributes):
+        """Run the app with its output sent to /dev/null and return the
+        elapsed time.
+        """
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'wb')
+        try:
+            app = app_class(args)
+            app.force_exit = False
+            for name, value in attributes.items():
+                setattr(app, name, value)
+            start = time.time()
+            app.run()
+            elapsed = time.time() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        app.close_connections()
+        return elapsed
+
+    def time_batch(self, app_class, command_lines):
+        "Return the time to run the command lines with run_batch()."
+        start = time.time()
+        for result in app_class.run_batch(command_lines):
+            if result.exit_code:
+                raise RuntimeError(result.error_output)
+        elapsed = time.time() - start
+        app_class.close_connections()
+        return elapsed
+
+    def report(self, name, elapsed, count, unit):
+        print '%-34s %8.2f %12.0f %s/s' % (name, elapsed, count / elapsed,
+                                            unit)
+        return
+
+    def time_searches(self, db):
+        "Return the average time for a showlog --message search."
+        elapsed = 0
+        for i in range(self.searches):
+            substring = 'message %d from' % (i * self.rows // self.searches)
+            elapsed += self.time_app(showlog.showlog,
+                                     ['--db', db, '--message', substring])
+        return elapsed / self.searches
+
+    def main(self):
+        tempdir = tempfile.mkdtemp(prefix='sqlite-benchmark-')
+        try:
+            db = os.path.join(tempdir, 'log.db')
+            print '%-34s %8s %12s' % ('case', 'seconds', 'rate')
+
+            for name, app_class, pragmas in [
+                ('execute per row', rowinsert, ()),
+                ('insert_many', bulkinsert, ()),
+                ('insert_many with pragmas', bulkinsert, FAST_PRAGMAS),
+                ]:
+                if os.path.exists(db):
+                    os.unlink(db)
+                elapsed = self.time_app(app_class, ['--db', db],
+                                        rows=self.rows, PRAGMAS=pragmas)
+                self.report(name, elapsed, self.rows, 'rows')
+
+            for name, app_class in [('print per row', printlog),
+                                    ('write_rows', showlog.showlog),
+                                    ]:
+                elapsed = self.time_app(app_class, ['--db', db])
+                self.report(name, elapsed, self.rows, 'rows')
+
+            print
+            print '%-34s %8s' % ('case', 'ms')
+            latency = self.time_searches(db)
+            print '%-34s %8.1f' % ('search with LIKE', latency * 1000)
+            elapsed = self.time_app(indexlog.indexlog, ['--db', db])
+            print '%-34s %8.1f' % ('create index', elapsed * 1000)
+            latency = self.time_searches(db)
+            print '%-34s %8.1f' % ('search with index', latency * 1000)
+            print
+
+            # Use a small table, so the cost of opening the database
+            # is not hidden by the query.
+            small_db = os.path.join(tempdir, 'small.db')
+            command_lines = [ ['--db', small_db] ] * self.queries
+            self.time_app(bulkinsert, ['--db', small_db], rows=10)
+            for name, reuse in [('batch, new connections', False),
+                                ('batch, reused connections', True),
+                                ]:
+                showlog.showlog.reuse_connections = reuse
+                elapsed = self.time_batch(showlog.showlog, command_lines)
+                self.report(name, elapsed, self.queries, 'commands')
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
+if __name__ == '__main__':
+    sqlite_benchmark().run()
@@ -34,15 +34,41 @@ simple as defining callbacks to handle options when they appear in
 #
 # Import system modules
 #
+import copy
+import gc
 import getopt
 import inspect
+import marshal
 import os
+import signal
+import stat
+import struct
 try:
     from cStringIO import StringIO
 except:
     from StringIO import StringIO
 import sys
 import textwrap
+import threading
+import time
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 #
 # Import Local modules
@@ -52,6 +78,1258 @@ import textwrap
 # Module
 #
 
+# The app whose main_item() is being run by a worker pool.  This is
+# kept at module level so forked worker processes can find it without
+# having to pickle the app.
+_fan_out_app = None
+
+# Timeout used while waiting for pool results, so the wait can be
+# interrupted by Control-C.
+_POOL_WAIT_TIMEOUT = 2 ** 31
+
+
+def _fan_out_worker(arg):
+    "Pool worker function used by CommandLineApp to call main_item()."
+    return _fan_out_app._call_main_item_in_worker(arg)
+
+
+def _exit_status(exit_code):
+    """Convert an exit code returned by the app to the integer status
+    the process would exit with.
+    """
+    if exit_code is None:
+        return 0
+    if isinstance(exit_code, int):
+        return exit_code
+    return 1
+
+
+class _ThreadLocalStream(object):
+    """File-like wrapper that collects writes made by a thread which has
+    started a capture, and passes everything else to the real stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+        return
+
+    def start_capture(self):
+        "Collect output written by the current thread."
+        self._local.buffer = StringIO()
+        return
+
+    def stop_capture(self):
+        "Stop collecting output for the current thread and return it."
+        buffer = self._local.buffer
+        del self._local.buffer
+        return buffer.getvalue()
+
+    def write(self, text):
+        getattr(self._local, 'buffer', self.stream).write(text)
+        return
+
+    def flush(self):
+        if not hasattr(self._local, 'buffer'):
+            self.stream.flush()
+        return
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class _FrameConnection(object):
+    """Send and receive the framed messages exchanged by
+    CommandLineApp.serve() and call_server().
+
+    Each frame is a one character type code followed by the length of
+    the data and the data itself.  The frame types are:
+
+      A - request arguments (marshaled argv, environment, and cwd)
+      I - a chunk of standard input (empty at end of file)
+      O - a chunk of standard output
+      E - a chunk of standard error
+      X - the exit code of the request
+    """
+
+    HEADER = struct.Struct('!cI')
+
+    def __init__(self, sock):
+        self.sock = sock
+        return
+
+    def write_frame(self, kind, data=''):
+        "Send one frame."
+        self.sock.sendall(self.HEADER.pack(kind, len(data)) + data)
+        return
+
+    def read_frame(self):
+        """Receive one frame and return a tuple containing its type and
+        data.  The type is None if the other side closed the connection.
+        """
+        header = self._read_exactly(self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            return (None, '')
+        kind, length = self.HEADER.unpack(header)
+        return (kind, self._read_exactly(length))
+
+    def _read_exactly(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+
+class _FrameOutput(object):
+    """File-like object that sends output to the client as frames,
+    buffering small writes.
+    """
+
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, connection, kind):
+        self.connection = connection
+        self.kind = kind
+        self._buffer = []
+        self._buffered = 0
+        return
+
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.BUFFER_SIZE:
+            self.flush()
+        return
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+        return
+
+    def flush(self):
+        if self._buffered:
+            self.connection.write_frame(self.kind, ''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        return
+
+    def isatty(self):
+        return False
+
+
+class _FrameInput(object):
+    """File-like object that reads the client's standard input from
+    frames.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._buffer = ''
+        self._eof = False
+        return
+
+    def _fill(self):
+        """Read the next chunk of input into the buffer.  Returns false
+        at the end of the input.
+        """
+        if self._eof:
+            return False
+        kind, data = self.connection.read_frame()
+        if kind != 'I' or not data:
+            self._eof = True
+            return False
+        self._buffer += data
+        return True
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [ self._buffer ]
+            self._buffer = ''
+            while self._fill():
+                chunks.append(self._buffer)
+                self._buffer = ''
+            return ''.join(chunks)
+        while len(self._buffer) < size and self._fill():
+            pass
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self):
+        while '\n' not in self._buffer and self._fill():
+            pass
+        end = self._buffer.find('\n') + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def isatty(self):
+        return False
+
+
+class BatchResult(object):
+    """The result of running one command line with run_batch().
+
+    Attributes:
+
+      command_line_options - The arguments given to the application.
+      exit_code            - The exit code of the application.
+      output               - Text written to standard output, if captured.
+      error_output         - Text written to standard error, if captured.
+    """
+
+    def __init__(self, command_line_options, exit_code,
+                 output=None, error_output=None):
+        self.command_line_options = command_line_options
+        self.exit_code = exit_code
+        self.output = output
+        self.error_output = error_output
+        return
+
+    def __repr__(self):
+        return '<BatchResult %r exit_code=%r>' % (self.command_line_options,
+                                                 self.exit_code)
+
+
+# The application class and class state used by the workers of
+# run_batch(), kept at module level so forked worker processes can
+# find them without pickling.
+_batch_app_state = None
+
+
+def _batch_worker(args):
+    "Pool worker function used by CommandLineApp.run_batch()."
+    app_class, class_state = _batch_app_state
+    command_line_options, capture = args
+    return app_class._run_batch_item(command_line_options, capture,
+                                     class_state)
+
+
+def _split_command_line(command_line):
+    """Return the arguments for a command line given either as a
+    string, which is split like a shell would, or a sequence.
+    """
+    if isinstance(command_line, basestring):
+        import shlex
+        return shlex.split(command_line)
+    return list(command_line)
+
+
+# Class attributes used by CommandLineApp to save work shared by all
+# instances.  They are not part of the state of the application, so
+# they are kept when the class state is reset.
+_CLASS_CACHE_ATTRIBUTES = ('_class_prepared', '_option_table', '_hook_table')
+
+
+def _is_class_data(name, value):
+    "Is the class attribute name part of the state of the application?"
+    if name.startswith('__') or name in _CLASS_CACHE_ATTRIBUTES:
+        return False
+    if inspect.isroutine(value):
+        return False
+    return not isinstance(value, (classmethod, staticmethod, property))
+
+
+def _get_class_state(cls):
+    """Return a snapshot of the data attributes of cls and its base
+    classes, to be used with _reset_class_state().
+    """
+    state = []
+    for klass in inspect.getmro(cls):
+        if klass is object:
+            continue
+        attributes = {}
+        for name, value in klass.__dict__.items():
+            if _is_class_data(name, value):
+                if isinstance(value, (list, dict, set)):
+                    value = copy.copy(value)
+                attributes[name] = value
+        state.append((klass, attributes))
+    return state
+
+
+def _reset_class_state(state):
+    """Undo any changes made to the class attributes saved in state,
+    including changes made in place to lists, dictionaries, and sets.
+    """
+    for klass, attributes in state:
+        for name, value in klass.__dict__.items():
+            if _is_class_data(name, value) and name not in attributes:
+                delattr(klass, name)
+        for name, value in attributes.items():
+            if isinstance(value, (list, dict, set)):
+                setattr(klass, name, copy.copy(value))
+            elif klass.__dict__.get(name) is not value:
+                setattr(klass, name, value)
+    return
+
+
+# Shell completion scripts produced by
+# CommandLineApp.get_completion_script().  Each receives the name of
+# the program, the name of the shell function to define, and the
+# completion switch.
+_COMPLETION_SCRIPTS = {
+    'bash': '''%(function)s_complete() {
+    local IFS=$'\\n'
+    local line
+    COMPREPLY=()
+    for line in $("${COMP_WORDS[0]}" %(switch)s "${COMP_WORDS[@]:1:COMP_CWORD}"); do
+        COMPREPLY+=("${line%%%%$'\\t'*}")
+    done
+}
+complete -o default -F %(function)s_complete %(name)s''',
+
+    'zsh': '''%(function)s_complete() {
+    local -a candidates
+    candidates=("${(@f)$(${words[1]} %(switch)s "${(@)words[2,CURRENT]}")}")
+    candidates=("${(@)candidates//:/\\:}")
+    candidates=("${(@)candidates//$'\\t'/:}")
+    if (( ${#candidates} )) && [[ -n "${candidates[1]}" ]]; then
+        _describe 'values' candidates
+    else
+        _files
+    fi
+}
+compdef %(function)s_complete %(name)s''',
+
+    'fish': """function %(function)s_complete
+    set -l tokens (commandline -opc)
+    set -l current (commandline -ct)
+    command $tokens[1] %(switch)s $tokens[2..-1] "$current"
+end
+complete -c %(name)s -a '(%(function)s_complete)'""",
+    }
+
+
+
+def _get_arguments_syntax(app):
+    """Return the syntax of the arguments to main() for app, which is an
+    application instance or class.
+    """
+    if app.SUBCOMMANDS:
+        return 'command [arguments...]'
+    syntax_parts = []
+    argspec = inspect.getargspec(app.main)
+    args = argspec[0]
+    if len(args) > 1:
+        for arg in args[1:]:
+            syntax_parts.append(arg)
+    if argspec[1]:
+        syntax_parts.append(argspec[1])
+        syntax_parts.append('[' + argspec[1] + '...]')
+    return ' '.join(syntax_parts)
+
+
+def _group_option_aliases(app, option_defs):
+    """Return a sorted list of (option_names, option_defs) tuples for
+    the options of app, which is an application instance or class,
+    grouping aliases together.
+    """
+    option_aliases = {}
+    for option in option_defs:
+        key = option.get_alias_key(app)
+        existing_aliases = option_aliases.setdefault(key, [])
+        existing_aliases.append(option)
+    grouped_options = []
+    for options in option_aliases.values():
+        names = [ o.option_name for o in options ]
+        grouped_options.append( (names, options) )
+    grouped_options.sort()
+    return grouped_options
+
+
+def _get_paragraphs(text):
+    "Split text into paragraphs, joining the lines of each one."
+    if not text:
+        return []
+    return [ ' '.join(para.split())
+             for para in textwrap.dedent(text).split('\n\n')
+             if para.strip() ]
+
+
+def _escape_roff(text):
+    "Quote text for use in a man page."
+    text = text.replace('\\', '\\e').replace('-', '\\-')
+    lines = []
+    for line in text.split('\n'):
+        if line.startswith('.') or line.startswith("'"):
+            line = '\\&' + line
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _render_man_page(parts):
+    "Return the help for an application as a roff man page."
+    lines = ['.TH %s 1 "" "%s"' % (_escape_roff(parts['name'].upper()),
+                                  _escape_roff(parts['title']))]
+    lines.extend(['.SH NAME', '%s \\- %s' % (
+                _escape_roff(parts['name']),
+                _escape_roff((parts['description'] or [''])[0]))])
+    lines.extend(['.SH SYNOPSIS', '.B %s' % _escape_roff(parts['name']),
+                  _escape_roff(parts['synopsis'])])
+    if parts['description'][1:]:
+        lines.append('.SH DESCRIPTION')
+        for para in parts['description'][1:]:
+            lines.extend(['.PP', _escape_roff(para)])
+    if parts['arguments']:
+        lines.append('.SH ARGUMENTS')
+        for para in parts['arguments']:
+            lines.extend(['.PP', _escape_roff(para)])
+    if parts['commands']:
+        lines.append('.SH COMMANDS')
+        for name, description in parts['commands']:
+            lines.extend(['.TP', '.B %s' % _escape_roff(name),
+                          _escape_roff(description)])
+    lines.append('.SH OPTIONS')
+    for switches, help in parts['options']:
+        lines.extend(['.TP', '.B %s' % _escape_roff(', '.join(switches))])
+        for i, para in enumerate(help):
+            if i:
+                lines.append('.IP')
+            lines.append(_escape_roff(para))
+    if parts['examples']:
+        lines.extend(['.SH EXAMPLES', '.nf',
+                      _escape_roff(parts['examples']), '.fi'])
+    return '\n'.join(lines) + '\n'
+
+
+def _escape_markdown(text):
+    "Quote the characters Markdown treats specially in text."
+    for c in '\\`*_[]<>#':
+        text = text.replace(c, '\\' + c)
+    return text
+
+
+def _render_markdown(parts):
+    "Return the help for an application as a Markdown document."
+    lines = ['# %s' % _escape_markdown(parts['title']), '']
+    for para in parts['description']:
+        lines.extend([_escape_markdown(para), ''])
+    lines.extend(['## Synopsis', '',
+                  '    %s %s' % (parts['name'], parts['synopsis']), ''])
+    if parts['arguments']:
+        lines.extend(['## Arguments', ''])
+        for para in parts['arguments']:
+            lines.extend([_escape_markdown(para), ''])
+    if parts['commands']:
+        lines.extend(['## Commands', ''])
+        for name, description in parts['commands']:
+            lines.append('* `%s`: %s' % (name, _escape_markdown(description)))
+        lines.append('')
+    lines.extend(['## Options', ''])
+    for switches, help in parts['options']:
+        lines.extend(['### %s' % ', '.join([ '`%s`' % s for s in switches ]),
+                      ''])
+        for para in help:
+            lines.extend([_escape_markdown(para), ''])
+    if parts['examples']:
+        lines.extend(['## Examples', ''])
+        lines.extend([ ('    ' + line).rstrip()
+                       for line in parts['examples'].split('\n') ])
+        lines.append('')
+    return '\n'.join(lines).rstrip('\n') + '\n'
+
+
+def _render_html(parts):
+    "Return the help for an application as an HTML document."
+    from cgi import escape
+    lines = ['<!DOCTYPE html>', '<html>', '<head>',
+             '<meta charset="utf-8">',
+             '<title>%s</title>' % escape(parts['title']),
+             '</head>', '<body>',
+             '<h1>%s</h1>' % escape(parts['title'])]
+    for para in parts['description']:
+        lines.append('<p>%s</p>' % escape(para))
+    lines.extend(['<h2>Synopsis</h2>', '<pre>%s %s</pre>' %
+                  (escape(parts['name']), escape(parts['synopsis']))])
+    if parts['arguments']:
+        lines.append('<h2>Arguments</h2>')
+        for para in parts['arguments']:
+            lines.append('<p>%s</p>' % escape(para))
+    if parts['commands']:
+        lines.extend(['<h2>Commands</h2>', '<dl>'])
+        for name, description in parts['commands']:
+            lines.extend(['<dt><code>%s</code></dt>' % escape(name),
+                          '<dd>%s</dd>' % escape(description)])
+        lines.append('</dl>')
+    lines.extend(['<h2>Options</h2>', '<dl>'])
+    for switches, help in parts['options']:
+        lines.append('<dt>%s</dt>' % ', '.join(
+                [ '<code>%s</code>' % escape(s) for s in switches ]))
+        lines.append('<dd>%s</dd>' % ''.join(
+                [ '<p>%s</p>' % escape(para) for para in help ]))
+    lines.append('</dl>')
+    if parts['examples']:
+        lines.extend(['<h2>Examples</h2>',
+                      '<pre>%s</pre>' % escape(parts['examples'])])
+    lines.extend(['</body>', '</html>'])
+    return '\n'.join(lines) + '\n'
+
+
+# Help document formats supported by CommandLineApp.render_help(), with
+# the function to produce each one and the extension used by
+# write_help_files().
+_HELP_RENDERERS = {
+    'man': (_render_man_page, '.1'),
+    'markdown': (_render_markdown, '.md'),
+    'html': (_render_html, '.html'),
+    }
+
+
+# Leading bytes used to recognize compressed input files.
+_GZIP_MAGIC = '\x1f\x8b'
+_BZ2_MAGIC = 'BZh'
+_XZ_MAGIC = '\xfd7zXZ\x00'
+
+
+def _read_magic(stream):
+    """Read the leading bytes of stream needed to recognize a compressed
+    file.  Reading stops at the first byte that does not match, so an
+    interactive user does not have to type ahead.
+    """
+    magic = ''
+    while len(magic) < len(_XZ_MAGIC):
+        data = stream.read(1)
+        if not data:
+            break
+        magic += data
+        if not [ m for m in (_GZIP_MAGIC, _BZ2_MAGIC, _XZ_MAGIC)
+                 if m.startswith(magic) ]:
+            break
+    return magic
+
+
+def _get_decompressor_factory(magic, filename):
+    """Return a function to create a decompressor object for data
+    starting with magic, or None if the data is not compressed.
+    """
+    if magic.startswith(_GZIP_MAGIC):
+        import zlib
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if magic.startswith(_BZ2_MAGIC):
+        import bz2
+        return bz2.BZ2Decompressor
+    if magic.startswith(_XZ_MAGIC):
+        if lzma is None:
+            raise IOError('Cannot read %s: xz support is not available'
+                          % filename)
+        return lzma.LZMADecompressor
+    return None
+
+
+def _open_compressed_file(filename, buffer_size):
+    """Open filename for reading, decompressing it if it starts with
+    the header of a gzip, bzip2, or xz file.
+    """
+    f = open(filename, 'rb', buffer_size)
+    magic = f.read(len(_XZ_MAGIC))
+    if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        # Pipes and devices cannot be rewound or opened again, so the
+        # bytes already read are returned ahead of the rest.
+        try:
+            factory = _get_decompressor_factory(magic, filename)
+        except:
+            f.close()
+            raise
+        return _PeekedStream(f, magic, buffer_size, factory)
+    if magic.startswith(_GZIP_MAGIC):
+        import gzip
+        f.close()
+        return gzip.GzipFile(filename, 'rb')
+    if magic.startswith(_BZ2_MAGIC):
+        import bz2
+        f.close()
+        return bz2.BZ2File(filename, 'rb', buffer_size)
+    if magic.startswith(_XZ_MAGIC):
+        f.close()
+        if lzma is None:
+            raise IOError('Cannot read %s: xz support is not available'
+                          % filename)
+        return lzma.LZMAFile(filename, 'rb')
+    f.seek(0)
+    return f
+
+
+class _PeekedStream(object):
+    """File-like object to read the rest of a stream that cannot seek,
+    after data has already been read from it.  The data can be passed
+    through decompressor objects made by decompressor_factory.  If
+    close_stream is false, close() leaves the stream open.
+    """
+
+    def __init__(self, stream, data, buffer_size, decompressor_factory=None,
+                 close_stream=True):
+        self.stream = stream
+        self.close_stream = close_stream
+        self.buffer_size = buffer_size
+        self._decompressor_factory = decompressor_factory
+        self._decompressor = None
+        if decompressor_factory is not None:
+            self._decompressor = decompressor_factory()
+        # Data read from the stream that has not been decompressed
+        self._pending = data
+        # Data ready to be returned, starting at _offset
+        self._buffer = ''
+        self._offset = 0
+        return
+
+    def _decompress(self, data):
+        "Return the data decompressed."
+        try:
+            result = self._decompressor.decompress(data)
+        except EOFError:
+            # Another compressed stream follows the one that ended.
+            self._decompressor = self._decompressor_factory()
+            result = self._decompressor.decompress(data)
+        unused = getattr(self._decompressor, 'unused_data', '')
+        if unused:
+            self._decompressor = self._decompressor_factory()
+            self._pending = unused
+        return result
+
+    def _fill(self):
+        """Add more data to the buffer.  Returns False at the end of the
+        stream.
+        """
+        while True:
+            data = self._pending or self.stream.read(self.buffer_size)
+            self._pending = ''
+            if not data:
+                return False
+            if self._decompressor is not None:
+                data = self._decompress(data)
+            if data:
+                self._buffer = self._buffer[self._offset:] + data
+                self._offset = 0
+                return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) - self._offset < size:
+            if not self._fill():
+                break
+        start = self._offset
+        end = len(self._buffer)
+        if size >= 0:
+            end = min(end, start + size)
+        self._offset = end
+        return self._buffer[start:end]
+
+    def readline(self):
+        searched = self._offset
+        while True:
+            end = self._buffer.find('\n', searched)
+            if end >= 0:
+                end += 1
+                break
+            # _fill() moves the unread data to the start of the buffer.
+            searched = len(self._buffer) - self._offset
+            if not self._fill():
+                end = len(self._buffer)
+                break
+        line = self._buffer[self._offset:end]
+        self._offset = end
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self.close_stream:
+            self.stream.close()
+        return
+
+
+class _CompressedStream(object):
+    """File-like wrapper that compresses data with a bz2 or lzma
+    compressor object before writing it to stream.
+    """
+
+    def __init__(self, stream, compressor):
+        self.stream = stream
+        self.compressor = compressor
+        return
+
+    def write(self, data):
+        self.stream.write(self.compressor.compress(data))
+        return
+
+    def flush(self):
+        self.stream.flush()
+        return
+
+    def close(self):
+        self.stream.write(self.compressor.flush())
+        return
+
+
+class _AtomicOutputFile(object):
+    """File-like object that writes to a temporary file next to
+    filename, which is renamed to filename by commit() or removed by
+    discard().  Names ending in .gz, .bz2, or .xz are compressed.
+    """
+
+    def __init__(self, filename, buffer_size):
+        import tempfile
+        self.filename = filename
+        dirname, basename = os.path.split(os.path.abspath(filename))
+        fd, self.temp_filename = tempfile.mkstemp(
+            dir=dirname, prefix='.%s.' % basename, suffix='.tmp')
+        # mkstemp() makes the file private, so give it the permissions
+        # of the file being replaced, or those a new file would
+        # normally have.
+        try:
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        os.chmod(self.temp_filename, mode)
+        self._file = os.fdopen(fd, 'wb', buffer_size)
+        extension = os.path.splitext(filename)[1]
+        if extension == '.gz':
+            import gzip
+            self._stream = gzip.GzipFile(basename[:-3], 'wb', 9, self._file)
+        elif extension == '.bz2':
+            import bz2
+            self._stream = _CompressedStream(self._file, bz2.BZ2Compressor())
+        elif extension == '.xz':
+            if lzma is None:
+                self.discard()
+                raise IOError('Cannot write %s: xz support is not available'
+                              % filename)
+            self._stream = _CompressedStream(self._file,
+                                             lzma.LZMACompressor())
+        else:
+            self._stream = self._file
+        self.write = self._stream.write
+        self.closed = False
+        return
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+        return
+
+    def flush(self):
+        self._stream.flush()
+        return
+
+    def _close(self):
+        self.closed = True
+        try:
+            if self._stream is not self._file:
+                self._stream.close()
+        finally:
+            self._file.close()
+        return
+
+    def commit(self):
+        "Finish writing and replace filename with the new contents."
+        try:
+            self._close()
+        except:
+            os.unlink(self.temp_filename)
+            raise
+        os.rename(self.temp_filename, self.filename)
+        return
+
+    def discard(self):
+        "Stop writing and remove the temporary file."
+        try:
+            self._close()
+        finally:
+            os.unlink(self.temp_filename)
+        return
+
+
+class Progress(object):
+    """Track and display the progress of a long running task.
+
+    Add to count as the work is done.  ``progress.count += 1`` is all
+    the bookkeeping needed for each item, since the display is updated
+    by a background thread at a fixed interval, no matter how often
+    the count changes.  On a terminal the status line is redrawn in
+    place.  Otherwise a line is written each time the display is
+    updated, so logs are not flooded.
+
+    Progress can be used as a context manager, which calls finish() at
+    the end of the block.
+
+    Attributes:
+
+      count      - The number of items done so far.
+      total      - The total number of items, or None if unknown.
+      label      - Text shown at the start of the status line.
+      stream     - Where the status line is written.
+      start_time - When the progress was started.
+    """
+
+    def __init__(self, total=None, label='', stream=None):
+        self.count = 0
+        self.total = total
+        self.label = label
+        self.stream = stream or sys.stderr
+        try:
+            self._is_tty = self.stream.isatty()
+        except AttributeError:
+            self._is_tty = False
+        self.start_time = time.time()
+        self._finished = threading.Event()
+        self._thread = None
+        self._last_width = 0
+        return
+
+    def update(self, amount=1):
+        "Add amount to the count of items done."
+        self.count += amount
+        return
+
+    def start(self, interval):
+        """Start displaying the progress every interval seconds in a
+        background thread.
+        """
+        self._thread = threading.Thread(target=self._display_loop,
+                                        args=(interval,))
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return
+
+    def finish(self):
+        "Stop the background display and show the final status."
+        if self._finished.isSet():
+            return
+        self._finished.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._display()
+            if self._is_tty:
+                self.stream.write('\n')
+                self.stream.flush()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.finish()
+        return False
+
+    def _display_loop(self, interval):
+        while True:
+            self._finished.wait(interval)
+            if self._finished.isSet():
+                break
+            self._display()
+        return
+
+    def _display(self):
+        text = self.get_status_text()
+        if self._is_tty:
+            padding = ' ' * max(self._last_width - len(text), 0)
+            self._last_width = len(text)
+            self.stream.write('\r%s%s' % (text, padding))
+        else:
+            self.stream.write(text + '\n')
+        self.stream.flush()
+        return
+
+    def get_status_text(self):
+        """Return the status line, showing the count, percent done,
+        throughput, and estimated time remaining.
+        """
+        count = self.count
+        elapsed = time.time() - self.start_time
+        rate = elapsed and count / elapsed or 0.0
+        parts = []
+        if self.label:
+            parts.append('%s:' % self.label)
+        if self.total:
+            parts.append('%d/%d (%.1f%%)' % (count, self.total,
+                                             100.0 * count / self.total))
+        else:
+            parts.append('%d' % count)
+        parts.append('%.1f/s' % rate)
+        if self.total and rate:
+            remaining = int(max(self.total - count, 0) / rate)
+            parts.append('ETA %d:%02d:%02d' % (remaining // 3600,
+                                               remaining // 60 % 60,
+                                               remaining % 60))
+        return ' '.join(parts)
+
+
+class ShutdownDeadlineExceeded(KeyboardInterrupt):
+    """Raised in the main thread when an application has not finished
+    within its shutdown_grace_period after a cancel signal, or when a
+    second cancel signal arrives.  run() exits with 128 plus the number
+    of the cancel signal.
+    """
+
+
+class Span(object):
+    """One timed operation in a trace of a run of an application.
+
+    Attributes:
+
+      name           - The name of the operation.
+      trace_id       - Hex identifier of the trace the span belongs to.
+      span_id        - Hex identifier of the span.
+      parent_span_id - Hex identifier of the parent span, or ''.
+      start_time     - Start time, in nanoseconds since the epoch.
+      end_time       - End time, in nanoseconds since the epoch.
+      attributes     - Dictionary describing the operation.
+      error          - Description of the error that ended the span, or None.
+    """
+
+    def __init__(self, name, trace_id, parent_span_id, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).encode('hex')
+        self.parent_span_id = parent_span_id
+        self.start_time = int(time.time() * 1e9)
+        self.end_time = None
+        self.attributes = attributes or {}
+        self.error = None
+        return
+
+    def __repr__(self):
+        return '<Span %s %s>' % (self.name, self.span_id)
+
+
+class _Tracer(object):
+    """Record the spans for one run of an application.
+    """
+
+    def __init__(self, exporter, traceparent=None):
+        self.exporter = exporter
+        self.spans = []
+        self._open_spans = []
+        self.trace_id = os.urandom(16).encode('hex')
+        self.parent_span_id = ''
+        # Continue a trace from the parent process, given in the W3C
+        # trace context format: version-trace_id-parent_id-flags
+        parts = (traceparent or '').split('-')
+        if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+            self.trace_id = parts[1]
+            self.parent_span_id = parts[2]
+        return
+
+    def start_span(self, name, attributes=None):
+        "Start a span inside the current span."
+        if self._open_spans:
+            parent_span_id = self._open_spans[-1].span_id
+        else:
+            parent_span_id = self.parent_span_id
+        span = Span(name, self.trace_id, parent_span_id, attributes)
+        self._open_spans.append(span)
+        return span
+
+    def end_span(self, error=None):
+        "End the current span."
+        span = self._open_spans.pop()
+        span.end_time = int(time.time() * 1e9)
+        span.error = error
+        self.spans.append(span)
+        return span
+
+    def end_open_spans(self, error=None):
+        "End all of the open spans except the root."
+        while len(self._open_spans) > 1:
+            self.end_span(error)
+        return
+
+    def finish(self, app, exit_code):
+        "End the root span and export the spans."
+        self.end_open_spans()
+        exit_status = _exit_status(exit_code)
+        root = self._open_spans[0]
+        root.attributes['process.exit_code'] = exit_status
+        self.end_span(exit_status and 'Exit code %d' % exit_status or None)
+        self.exporter.export(app, self.spans)
+        return
+
+
+def _otlp_value(value):
+    "Return the OTLP JSON encoding of an attribute value."
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, (int, long)):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    if isinstance(value, (list, tuple)):
+        return {'arrayValue': {'values': [ _otlp_value(v) for v in value ]}}
+    return {'stringValue': value}
+
+
+def _otlp_attributes(attributes):
+    "Return the OTLP JSON encoding of an attribute dictionary."
+    return [ {'key': key, 'value': _otlp_value(value)}
+             for key, value in sorted(attributes.items()) ]
+
+
+class FileSpanExporter(object):
+    """Append the spans for each run of an application to a file.
+
+    Each run is written as one line containing an OTLP JSON trace
+    export request, so the file can be loaded into tracing tools
+    without a collector running.
+
+    Use an instance as the trace_exporter of an application, or write
+    other exporters with the same export() method.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        return
+
+    def export(self, app, spans):
+        "Write the spans recorded for a run of app."
+        import json
+        otlp_spans = []
+        for span in spans:
+            otlp_span = {
+                'traceId': span.trace_id,
+                'spanId': span.span_id,
+                'name': span.name,
+                'kind': 1,  # SPAN_KIND_INTERNAL
+                'startTimeUnixNano': str(span.start_time),
+                'endTimeUnixNano': str(span.end_time),
+                'attributes': _otlp_attributes(span.attributes),
+                'status': {'code': 1},  # STATUS_CODE_OK
+                }
+            if span.parent_span_id:
+                otlp_span['parentSpanId'] = span.parent_span_id
+            if span.error:
+                otlp_span['status'] = {'code': 2,  # STATUS_CODE_ERROR
+                                       'message': span.error}
+            otlp_spans.append(otlp_span)
+        resource = {'service.name': app._app_name}
+        if app._app_version:
+            resource['service.version'] = app._app_version
+        request = {'resourceSpans': [{
+                    'resource': {'attributes': _otlp_attributes(resource)},
+                    'scopeSpans': [{'scope': {'name': 'commandlineapp'},
+                                    'spans': otlp_spans,
+                                    }],
+                    }]}
+        output = open(self.filename, 'a')
+        try:
+            output.write(json.dumps(request, sort_keys=True) + '\n')
+        finally:
+            output.close()
+        return
+
+
+def _get_cache_dir():
+    "Return the directory for the files cached by CommandLineApp."
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'commandlineapp')
+
+
+def _write_file_atomically(filename, data):
+    """Write data to a file so that readers either see the old
+    contents or the new contents, but never a partial file.
+    """
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    output = open(temp_filename, 'wb')
+    try:
+        output.write(data)
+    finally:
+        output.close()
+    os.rename(temp_filename, filename)
+    return
+
+
+def _prune_cache_dir(dirname, max_size):
+    """Remove the least recently used files from dirname until the
+    total size of the files is no more than max_size bytes.
+    """
+    entries = []
+    total_size = 0
+    for name in os.listdir(dirname):
+        filename = os.path.join(dirname, name)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        entries.append( (stat.st_mtime, stat.st_size, filename) )
+        total_size += stat.st_size
+    entries.sort()
+    for mtime, size, filename in entries:
+        if total_size <= max_size:
+            break
+        try:
+            os.unlink(filename)
+        except OSError:
+            continue
+        total_size -= size
+    return
+
+
+class _TeeStream(object):
+    """File-like wrapper that keeps a copy of the text written to the
+    stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._copy = StringIO()
+        return
+
+    def write(self, text):
+        self.stream.write(text)
+        self._copy.write(text)
+        return
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+        return
+
+    def getvalue(self):
+        "Return the text written so far."
+        return self._copy.getvalue()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+# Configuration files parsed by this process, by filename.  The
+# values are tuples containing the modification time and size of the
+# file when it was parsed, and the parsed data.
+_config_cache = {}
+
+
+def _load_config_file(filename):
+    """Return the contents of an INI or TOML configuration file as a
+    dictionary mapping section names to dictionaries of values.
+
+    The parsed form is cached in memory and in the cache directory,
+    keyed by the modification time and size of the file, so many short
+    lived processes reading the same file only parse it once.
+    """
+    stat = os.stat(filename)
+    signature = (stat.st_mtime, stat.st_size)
+
+    cached = _config_cache.get(filename)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    import hashlib
+    cache_filename = os.path.join(
+        _get_cache_dir(),
+        'config-%s.marshal' % hashlib.md5(filename).hexdigest())
+    try:
+        cache_file = open(cache_filename, 'rb')
+        try:
+            cached_filename, cached_signature, data = marshal.load(cache_file)
+        finally:
+            cache_file.close()
+        if cached_filename == filename and cached_signature == signature:
+            _config_cache[filename] = (signature, data)
+            return data
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+
+    if filename.endswith('.toml'):
+        data = _parse_toml_file(filename)
+    else:
+        data = _parse_ini_file(filename)
+    _config_cache[filename] = (signature, data)
+    try:
+        _write_file_atomically(cache_filename,
+                               marshal.dumps((filename, signature, data)))
+    except (IOError, OSError, ValueError):
+        # The cache is only an optimization.
+        pass
+    return data
+
+
+def _parse_ini_file(filename):
+    "Parse an INI configuration file for _load_config_file()."
+    import ConfigParser
+    parser = ConfigParser.RawConfigParser()
+    config_file = open(filename, 'rt')
+    try:
+        parser.readfp(config_file)
+    finally:
+        config_file.close()
+    data = {}
+    for section in parser.sections():
+        data[section] = dict(parser.items(section))
+    return data
+
+
+def _parse_toml_file(filename):
+    "Parse a TOML configuration file for _load_config_file()."
+    try:
+        import tomllib as toml
+    except ImportError:
+        try:
+            import toml
+        except ImportError:
+            raise RuntimeError('Reading %s requires the toml package' % filename)
+    config_file = open(filename, 'rb')
+    try:
+        return toml.loads(config_file.read().decode('utf-8'))
+    finally:
+        config_file.close()
+
+
+def _is_coroutine_function(func):
+    """Return true if func is a coroutine function that needs to be
+    run in an event loop.
+    """
+    if asyncio is None:
+        return False
+    return asyncio.iscoroutinefunction(func)
+
+
+# Functions used by OptionDef.bind() to make the function that calls an
+# option handler, depending on how the handler takes its arguments.
+
+def _bind_direct(opt_def, method):
+    return method
+
+
+def _bind_no_arg(opt_def, method):
+    return lambda arg: method()
+
+
+def _bind_variable(opt_def, method):
+    split_char = opt_def.SPLIT_PARAM_CHAR
+    return lambda arg: method(*arg.split(split_char))
+
+
+def _bind_append(opt_def, method):
+    get_values = opt_def.get_accumulated_values
+    return lambda args: method(get_values(args))
+
+
+def _bind_append_variable(opt_def, method):
+    get_values = opt_def.get_accumulated_values
+    return lambda args: method(*get_values(args))
+
+
 class OptionDef(object):
     """Definition for a command line option.
 
@@ -73,6 +1351,19 @@ class OptionDef(object):
     # For *args arguments to option handlers, how to split the argument values
     SPLIT_PARAM_CHAR = ','
 
+    # Constraints checked by CommandLineApp.check_option_constraints(),
+    # set with the option_constraints() decorator or by Option.
+    required = False
+    choices = None
+    min_value = None
+    max_value = None
+    requires = ()
+    conflicts = ()
+
+    # How repeated uses of the option are combined ('append' or
+    # 'count'), set with the accumulate_option() decorator or by Option
+    accumulate = None
+
     def __init__(self, method_name, method):
         self.method_name = method_name
         self.option_name = method_name[len(self.OPTION_HANDLER_PREFIX):]
@@ -102,6 +1393,28 @@ class OptionDef(object):
             self.default = None
 
         self.help = inspect.getdoc(method)
+        self.is_coroutine = _is_coroutine_function(method)
+        self.__dict__.update(getattr(method, 'option_constraints', {}))
+        self.accumulate = getattr(method, 'option_accumulate', None)
+        if self.accumulate == 'count':
+            # The argument of the handler is the count, which is not
+            # given on the command line.
+            self.arg_name = None
+            self.default = None
+
+        if self.accumulate == 'count':
+            self._make_invoker = _bind_direct
+        elif self.accumulate == 'append':
+            if self.is_variable:
+                self._make_invoker = _bind_append_variable
+            else:
+                self._make_invoker = _bind_append
+        elif not self.arg_name:
+            self._make_invoker = _bind_no_arg
+        elif self.is_variable:
+            self._make_invoker = _bind_variable
+        else:
+            self._make_invoker = _bind_direct
         return
 
     def get_switch_text(self):
@@ -121,20 +1434,306 @@ class OptionDef(object):
         return ''.join(parts)
 
 
+    def get_alias_key(self, app):
+        """Return a value shared by the OptionDefs for the aliases of
+        one option.
+        """
+        return getattr(app, self.method_name)
+
+    def get_values(self, arg):
+        """Return the list of values given by the argument arg, to be
+        checked against the choices and range of the option.
+        """
+        if self.is_variable:
+            return arg.split(self.SPLIT_PARAM_CHAR)
+        return [arg]
+
+    def check_value(self, arg):
+        """Return a list of messages describing the ways arg is not
+        a valid value for the option.
+        """
+        if not self.arg_name:
+            return []
+        try:
+            values = self.get_values(arg)
+        except ValueError, err:
+            return [str(err)]
+        messages = []
+        for value in values:
+            if self.choices is not None and value not in self.choices:
+                messages.append('%s must be one of %s, not %r' %
+                                (self.switch,
+                                 ', '.join([ str(c) for c in self.choices ]),
+                                 value))
+            for bound, text in ((self.min_value, 'at least'),
+                                (self.max_value, 'at most')):
+                if bound is None:
+                    continue
+                try:
+                    number = type(bound)(value)
+                except ValueError:
+                    messages.append('Invalid value for %s: %r' %
+                                    (self.switch, value))
+                    break
+                if (text == 'at least' and number < bound) or \
+                        (text == 'at most' and number > bound):
+                    messages.append('%s must be %s %s, not %r' %
+                                    (self.switch, text, bound, value))
+        return messages
+
+    def get_accumulated_values(self, args):
+        "Return the list of values given by each of the arguments args."
+        values = []
+        for arg in args:
+            values.extend(self.get_values(arg))
+        return values
+
+    def bind(self, app):
+        """Return a function that calls the option handler of app with
+        the argument from the command line.
+
+        For options that accumulate, the argument is the count or the
+        list of arguments given for all of the uses of the option.
+
+        The handler is looked up once, and how it takes its arguments
+        was worked out when the OptionDef was made, so each use of the
+        function is a direct call.
+        """
+        invoker = self._make_invoker(self, getattr(app, self.method_name))
+        return self._finish_invoker(app, invoker)
+
+    def _finish_invoker(self, app, invoker):
+        "Wrap invoker to run the coroutine returned by the handler."
+        if not self.is_coroutine:
+            return invoker
+        return lambda arg: app._run_coroutine(invoker(arg))
+
     def invoke(self, app, arg):
         """Invoke the option handler.
         """
-        method = getattr(app, self.method_name)
-        if self.arg_name:
+        self.bind(app)(arg)
+        return
+
+
+# Option handlers that show help instead of running the app.  When one
+# of them is used, options that are missing or used together are not
+# reported, so the help can always be shown.
+_HELP_OPTION_HANDLERS = ('option_handler_h', 'option_handler_help')
+
+
+# Keyword arguments accepted by option_constraints()
+_OPTION_CONSTRAINTS = ('required', 'choices', 'min_value', 'max_value',
+                       'requires', 'conflicts')
+
+
+def option_constraints(**constraints):
+    """Decorator to add constraints to an option handler method,
+    which are checked before any option handlers are called.
+
+      required  - The option must be given.
+      choices   - Sequence of the allowed values.
+      min_value - Smallest allowed value.  The argument is converted
+                  to the type of min_value to compare it.
+      max_value - Largest allowed value, like min_value.
+      requires  - Names of other options that must be given when this
+                  one is.
+      conflicts - Names of other options that cannot be given when
+                  this one is.
+
+    For example::
+
+        @option_constraints(min_value=1, max_value=10)
+        def option_handler_retries(self, num):
+            ...
+    """
+    unknown = set(constraints) - set(_OPTION_CONSTRAINTS)
+    if unknown:
+        raise TypeError('Unknown option constraints: %s' %
+                        ', '.join(sorted(unknown)))
+    def decorate(method):
+        method.option_constraints = constraints
+        return method
+    return decorate
+
+
+def accumulate_option(mode='append'):
+    """Decorator for an option handler method that should be called
+    once, no matter how many times the option is given.
+
+    With mode 'append', the handler is called with all of the values
+    given, as separate arguments if it takes ``*args`` or as a list
+    otherwise.  With mode 'count', the option takes no argument on the
+    command line and the handler is called with the number of times it
+    was given.
+    """
+    if mode not in ('append', 'count'):
+        raise ValueError('Unknown accumulate mode %r' % mode)
+    def decorate(method):
+        method.option_accumulate = mode
+        return method
+    return decorate
+
+
+class Option(object):
+    """Declare a command line option as a class attribute, instead of
+    defining an option handler method.
+
+    For example::
+
+        class app(CommandLineApp):
+            limit = Option('limit', aliases=['l'], type=int, default=10,
+                           arg_name='num', help='Show at most num items.')
+
+    When the option is given, the value is converted with type and
+    saved in the attribute, so ``self.limit`` is 10 unless --limit or
+    -l is used.  An option without a type or arg_name takes no argument
+    and sets the attribute to True.  If is_variable is true, the value
+    is split on commas and each part converted, giving a list.  If
+    handler is the name of a method, that method is called with the
+    converted value instead of setting the attribute.  Other keyword
+    arguments are constraints, as for option_constraints(), and choices
+    and ranges are compared with the converted values.
+
+    If accumulate is 'append', the value is the list of the values from
+    every use of the option.  If it is 'count', the option takes no
+    argument and the value is the number of times it was given.
+
+    Declared options are compiled into the option table along with the
+    option handler methods, replacing any handler for the same name.
+    """
+
+    def __init__(self, name, aliases=(), type=None, default=None, help='',
+                 arg_name=None, is_variable=False, handler=None,
+                 accumulate=None, **constraints):
+        self.name = name.replace('-', '_')
+        self.aliases = tuple([ a.replace('-', '_') for a in aliases ])
+        if type is not None and arg_name is None:
+            arg_name = 'value'
+        elif type is None and arg_name is not None:
+            type = str
+        self.type = type
+        self.default = default
+        self.help = help
+        self.arg_name = arg_name
+        self.is_variable = is_variable
+        self.handler = handler
+        if accumulate is not None:
+            accumulate_option(accumulate)
+            if accumulate == 'count' and arg_name is not None:
+                raise ValueError('Counted options do not take arguments')
+        self.accumulate = accumulate
+        # Checked the same way as for option_constraints()
+        option_constraints(**constraints)
+        self.constraints = constraints
+        # The name of the class attribute, set when the class is scanned
+        self.attribute = self.name
+        return
+
+    def __get__(self, app, app_class):
+        if app is None:
+            return self
+        return app.__dict__.get(self.attribute, self.default)
+
+    def convert(self, switch, arg):
+        "Return the value for the argument arg given for switch."
+        try:
             if self.is_variable:
-                opt_args = arg.split(self.SPLIT_PARAM_CHAR)
-                method(*opt_args)
-            else:
-                method(arg)
+                return [ self.type(a)
+                         for a in arg.split(OptionDef.SPLIT_PARAM_CHAR) ]
+            return self.type(arg)
+        except ValueError:
+            raise ValueError('Invalid value for %s: %r' % (switch, arg))
+
+
+class _DeclaredOptionDef(OptionDef):
+    """Definition for a command line option declared with Option,
+    for the option name or one of its aliases.
+    """
+
+    def __init__(self, option, option_name, app_class):
+        self.option = option
+        self.method_name = self.OPTION_HANDLER_PREFIX + option_name
+        self.option_name = option_name
+        self.is_long = len(option_name) > 1
+        self.switch_base = option_name.replace('_', '-')
+        if self.is_long:
+            self.switch = '--' + self.switch_base
         else:
-            method()
+            self.switch = '-' + self.switch_base
+        self.arg_name = option.arg_name
+        self.is_variable = option.is_variable
+        self.default = option.default
+        self.help = option.help and inspect.cleandoc(option.help)
+        if option.handler:
+            self.is_coroutine = _is_coroutine_function(
+                getattr(app_class, option.handler))
+        else:
+            self.is_coroutine = False
+        self.__dict__.update(option.constraints)
+        self.accumulate = option.accumulate
         return
 
+    def get_alias_key(self, app):
+        return self.option
+
+    def get_values(self, arg):
+        value = self.option.convert(self.switch, arg)
+        if self.is_variable:
+            return value
+        return [value]
+
+    def bind(self, app):
+        """Return a function that saves the option value in app, or
+        passes it to the handler method.
+        """
+        option = self.option
+        switch = self.switch
+        if self.accumulate == 'count':
+            get_value = lambda arg: arg
+        elif self.accumulate == 'append':
+            get_value = self.get_accumulated_values
+        elif self.arg_name:
+            get_value = lambda arg: option.convert(switch, arg)
+        else:
+            get_value = lambda arg: True
+
+        if not option.handler:
+            attributes = app.__dict__
+            name = option.attribute
+            def invoker(arg):
+                attributes[name] = get_value(arg)
+            return invoker
+
+        method = getattr(app, option.handler)
+        if self.accumulate:
+            invoker = lambda arg: method(get_value(arg))
+        elif not self.arg_name:
+            invoker = lambda arg: method()
+        elif self.is_variable:
+            invoker = lambda arg: method(*get_value(arg))
+        else:
+            invoker = lambda arg: method(get_value(arg))
+        return self._finish_invoker(app, invoker)
+
+
+def _import_class(spec):
+    """Return the class named by spec.
+
+    The spec is a string of the form ``'package.module:ClassName'`` or
+    ``'package.module.ClassName'``.
+    """
+    if ':' in spec:
+        module_name, class_name = spec.split(':', 1)
+    else:
+        module_name, class_name = spec.rsplit('.', 1)
+    __import__(module_name)
+    return getattr(sys.modules[module_name], class_name)
+
+
+# Incremented whenever a hook is added or removed, so the hook tables
+# cached on the classes are rebuilt.
+_hook_generation = 0
+
 
 class CommandLineApp(object):
     """Base class for building command line applications.
@@ -151,24 +1750,347 @@ class CommandLineApp(object):
 
     EXAMPLES_DESCRIPTION = ''
 
+    # Configuration files to read option values from, in order, before
+    # the command line is processed.  Names may start with ~, and
+    # missing files are ignored.  Files ending in .toml are parsed as
+    # TOML, and everything else as INI.
+    CONFIG_FILES = ()
+
+    # The section of the configuration files containing the values for
+    # this app.  Defaults to the name of the app, without an extension.
+    CONFIG_SECTION = None
+
+    # When set, environment variables named with this prefix and the
+    # name of an option (for example APP_VERBOSE) are used as option
+    # values after the configuration files.
+    ENVIRONMENT_PREFIX = None
+
+    # Maps command names to the CommandLineApp subclasses that
+    # implement them, or to the names of those classes (see
+    # fork_launcher()) so they are only imported when used.  When not
+    # empty, the first argument after the options is the name of a
+    # command, and the rest of the command line is handled by its class.
+    SUBCOMMANDS = {}
+
     # If true, always ends run() with sys.exit()
     force_exit = True
 
+    # If false, only the option handler methods defined by
+    # CommandLineApp are looked for, and options added by subclasses
+    # must be declared with Option, so building the option table does
+    # not have to examine every method of the class.
+    SCAN_OPTION_HANDLERS = True
+
+    # Groups of option names, where only one option from each group
+    # can be given.
+    EXCLUSIVE_OPTION_GROUPS = ()
+
+    # Hidden switches used by the shell completion scripts.  When one
+    # of them is the first argument, the app only builds its option
+    # table, skipping the setup hooks, so it can respond quickly.
+    COMPLETION_SWITCH = '--_complete'
+    COMPLETION_SCRIPT_SWITCH = '--_completion-script'
+
     # The name of this application
     _app_name = os.path.basename(sys.argv[0])
 
     _app_version = None
 
-    def __init__(self, command_line_options=None):
-        "Initialize CommandLineApp."
+    def __init__(self, command_line_options=None, parent_app=None):
+        """Initialize CommandLineApp.
+
+        When the app is run as a subcommand, parent_app is the
+        application that selected it.  The debugging and verbose level
+        settings of the parent are used as the defaults for the
+        subcommand.
+        """
         if command_line_options is None:
             command_line_options = sys.argv[1:]
         self.command_line_options = command_line_options
+        self.parent_app = parent_app
+        self._option_invokers = {}
+        if parent_app is not None:
+            self.debugging = parent_app.debugging
+            self.verbose_level = parent_app.verbose_level
+        if self._is_completion_request():
+            self.supported_options = self.scan_for_options()
+            return
+        self.prepare_class()
+        hooks = self._get_hooks()
         self.before_options_hook()
+        if hooks['before_scan']:
+            self._call_hooks(hooks['before_scan'])
         self.supported_options = self.scan_for_options()
+        if hooks['after_scan']:
+            self._call_hooks(hooks['after_scan'], self.supported_options)
         self.after_options_hook()
         return
 
+    ## HOOKS
+
+    # The events reported to the callbacks registered with add_hook(),
+    # and the arguments passed to the callbacks after the app.
+    HOOK_EVENTS = (
+        'before_scan',    # ()
+        'after_scan',     # (option_defs,)
+        'before_option',  # (option_def, value)
+        'after_option',   # (option_def, value)
+        'before_main',    # (args,)
+        'after_main',     # (exit_code,)
+        'exception',      # (err,)
+        'exit',           # (exit_code,)
+        )
+
+    @classmethod
+    def add_hook(cls, event, callback):
+        """Register callback to be called for event by this class and
+        its subclasses.
+
+        Callbacks are called with the app and the arguments listed in
+        HOOK_EVENTS.  Callbacks registered on base classes are called
+        before those registered on subclasses, and otherwise they are
+        called in the order they were registered.
+        """
+        global _hook_generation
+        if event not in cls.HOOK_EVENTS:
+            raise ValueError('Unknown hook event "%s"' % event)
+        if '_registered_hooks' not in cls.__dict__:
+            cls._registered_hooks = {}
+        cls._registered_hooks.setdefault(event, []).append(callback)
+        _hook_generation += 1
+        return
+
+    @classmethod
+    def remove_hook(cls, event, callback):
+        "Remove a callback registered with add_hook()."
+        global _hook_generation
+        cls.__dict__['_registered_hooks'][event].remove(callback)
+        _hook_generation += 1
+        return
+
+    @classmethod
+    def _get_hooks(cls):
+        """Return a dictionary mapping each event to a tuple of its
+        callbacks, building it if hooks have changed.
+        """
+        cached = cls.__dict__.get('_hook_table')
+        if cached is not None and cached[0] == _hook_generation:
+            return cached[1]
+        hooks = {}
+        for event in cls.HOOK_EVENTS:
+            callbacks = []
+            for klass in reversed(inspect.getmro(cls)):
+                registered = klass.__dict__.get('_registered_hooks', {})
+                callbacks.extend(registered.get(event, ()))
+            hooks[event] = tuple(callbacks)
+        cls._hook_table = (_hook_generation, hooks)
+        return hooks
+
+    def _call_hooks(self, callbacks, *args):
+        "Call each of the callbacks for an event."
+        for callback in callbacks:
+            callback(self, *args)
+        return
+
+    @classmethod
+    def class_setup_hook(cls):
+        """Hook to do expensive setup shared by all instances of the app.
+
+        Override this classmethod to import modules, load data, or do
+        other work that does not depend on the command line.  It is
+        called once per class, before the first instance is
+        initialized, or by serve() and fork_launcher() before they
+        start handling command lines.
+        """
+        return
+
+    @classmethod
+    def prepare_class(cls):
+        """Do the work shared by all instances of the application.
+
+        Calls class_setup_hook() and scans for option handlers the
+        first time it is called for each class.
+        """
+        if cls.__dict__.get('_class_prepared'):
+            return
+        cls.class_setup_hook()
+        cls._get_option_table()
+        cls._class_prepared = True
+        return
+
+    @classmethod
+    def serve(cls, socket_path, fork=False):
+        """Run the application as a server on a Unix socket.
+
+        The server stays running and handles each command line sent by
+        call_server() with a new instance of the application, so the
+        cost of starting the interpreter and importing modules is only
+        paid once.  The request's standard input, environment, and
+        working directory are used while the application runs, and its
+        output and exit code are sent back to the client.
+
+        Requests are handled one at a time, unless fork is true.  Then
+        each request is handled in a child process forked from the
+        prepared server, so requests can run concurrently and cannot
+        change the state of the server.  Otherwise changes to the class
+        attributes made while handling one request are undone before
+        the next one starts, as they are by run_batch().
+        """
+        import SocketServer
+
+        class RequestHandler(SocketServer.BaseRequestHandler):
+            def handle(self):
+                try:
+                    cls._handle_server_request(self.request)
+                finally:
+                    _reset_class_state(class_state)
+
+        if fork:
+            class Server(SocketServer.ForkingMixIn,
+                         SocketServer.UnixStreamServer):
+                pass
+        else:
+            Server = SocketServer.UnixStreamServer
+
+        cls.prepare_class()
+        class_state = _get_class_state(cls)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = Server(socket_path, RequestHandler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+        return
+
+    @classmethod
+    def _handle_server_request(cls, sock):
+        "Run one command line received by serve()."
+        connection = _FrameConnection(sock)
+        kind, data = connection.read_frame()
+        if kind != 'A':
+            return
+        request = marshal.loads(data)
+        stdout = _FrameOutput(connection, 'O')
+        stderr = _FrameOutput(connection, 'E')
+
+        original_environ = dict(os.environ)
+        original_cwd = os.getcwd()
+        os.environ.clear()
+        os.environ.update(request['env'])
+        try:
+            os.chdir(request['cwd'])
+            exit_code = cls._run_with_streams(
+                request['argv'], _FrameInput(connection), stdout, stderr)
+        finally:
+            os.chdir(original_cwd)
+            os.environ.clear()
+            os.environ.update(original_environ)
+        stdout.flush()
+        stderr.flush()
+        connection.write_frame('X', str(_exit_status(exit_code)))
+        return
+
+    @classmethod
+    def run_batch(cls, command_lines, jobs=1, capture=True):
+        """Run many command lines with the application in this process.
+
+        Each command line is either a string, which is split like a
+        shell would, or a sequence of arguments.  The class is prepared
+        once, and then each command line is run by a new instance with
+        an empty standard input, without exiting.  Changes to the class
+        attributes made while running one command line are undone
+        before the next one starts.
+
+        If capture is true, the output of each command line is
+        collected instead of being written to the standard streams.  If
+        jobs is greater than 1, the command lines are run by a pool of
+        that many worker processes.
+
+        Generates a BatchResult for each command line, in order.
+        """
+        global _batch_app_state
+        cls.prepare_class()
+        class_state = _get_class_state(cls)
+        if jobs <= 1:
+            for command_line in command_lines:
+                yield cls._run_batch_item(_split_command_line(command_line),
+                                          capture, class_state)
+            return
+
+        from multiprocessing import Pool
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _batch_app_state = (cls, class_state)
+        pool = Pool(jobs)
+        try:
+            work = ( (_split_command_line(c), capture) for c in command_lines )
+            results = pool.imap(_batch_worker, work)
+            while True:
+                try:
+                    yield results.next(_POOL_WAIT_TIMEOUT)
+                except StopIteration:
+                    break
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _batch_app_state = None
+        return
+
+    @classmethod
+    def _run_batch_item(cls, command_line_options, capture, class_state):
+        "Run one command line for run_batch() and return a BatchResult."
+        if capture:
+            stdout = StringIO()
+            stderr = StringIO()
+        else:
+            stdout = sys.stdout
+            stderr = sys.stderr
+        try:
+            exit_code = cls._run_with_streams(command_line_options,
+                                              StringIO(''), stdout, stderr)
+        finally:
+            _reset_class_state(class_state)
+        result = BatchResult(command_line_options, _exit_status(exit_code))
+        if capture:
+            result.output = stdout.getvalue()
+            result.error_output = stderr.getvalue()
+        else:
+            stdout.flush()
+        return result
+
+    @classmethod
+    def _run_with_streams(cls, command_line_options, stdin, stdout, stderr):
+        """Run a new instance of the application with the standard
+        streams replaced, and return its exit code.
+
+        The application is never allowed to exit the current process.
+        """
+        original_streams = (sys.stdin, sys.stdout, sys.stderr)
+        sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+        try:
+            try:
+                app = cls(command_line_options)
+                app.force_exit = False
+                exit_code = app.run()
+            except SystemExit, msg:
+                exit_code = msg.code
+                if exit_code is not None and not isinstance(exit_code, int):
+                    stderr.write('%s\n' % exit_code)
+            except getopt.error:
+                # call_getopt() has already shown the help
+                exit_code = 1
+            except Exception, err:
+                stderr.write('ERROR: %s\n' % err)
+                exit_code = 1
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = original_streams
+        return exit_code
+
     def before_options_hook(self):
         """Hook to initialize the app before the options are processed.
 
@@ -198,6 +2120,84 @@ class CommandLineApp(object):
         """
         pass
 
+    # Define a main_item(self, arg) method instead of main() to have
+    # run() call it once for each argument, in parallel when --jobs is
+    # given.  Exceptions are passed to handle_main_exception() for each
+    # item, and the highest exit code returned by any item becomes the
+    # exit code of the program.  A coroutine main_item() is run in the
+    # app's event loop for one argument at a time, since the loop cannot
+    # be shared by the workers used for --jobs.
+    main_item = None
+
+    # If true, the output and exit code of main() are saved, and
+    # replayed instead of running main() again when the app is run with
+    # the same options, arguments, and input files.  Only use this for
+    # apps whose output depends on nothing else.
+    cache_results = False
+
+    # The maximum total size, in bytes, of the saved results.  The least
+    # recently used results are removed first.
+    RESULT_CACHE_SIZE = 64 * 1024 * 1024
+
+    # If true, the contents of the input files are compared instead of
+    # their modification times and sizes.
+    RESULT_CACHE_HASH_INPUTS = False
+
+    def get_cache_input_files(self, *args):
+        """Return the names of the files main() reads when run with args.
+
+        Override this method in apps that set cache_results, so saved
+        results are not reused after an input file changes.
+        """
+        return []
+
+    # Receives the spans describing each run of the app (see
+    # FileSpanExporter).  When None, spans are only recorded if the
+    # environment variable named by TRACE_FILE_VARIABLE is set, and they
+    # are written to the file it names.
+    trace_exporter = None
+    TRACE_FILE_VARIABLE = 'COMMANDLINEAPP_TRACE_FILE'
+
+    def _get_tracer(self):
+        "Return a _Tracer for this run, or None if tracing is off."
+        exporter = self.trace_exporter
+        if exporter is None:
+            filename = os.environ.get(self.TRACE_FILE_VARIABLE)
+            if not filename:
+                return None
+            exporter = FileSpanExporter(filename)
+        return _Tracer(exporter, os.environ.get('TRACEPARENT'))
+
+    # Names of the signals that ask the app to stop, such as
+    # ('SIGTERM', 'SIGHUP').  None are handled by default, so only apps
+    # that check cancelled should set this.  When one arrives while
+    # run() is active, cancelled is set and handle_signal() is called,
+    # and main() is expected to notice and return.  A second signal, or
+    # reaching the end of shutdown_grace_period seconds, interrupts
+    # main() with ShutdownDeadlineExceeded, and the program exits with
+    # 128 plus the signal number, the way it would have if it had been
+    # killed by the signal.  Add 'SIGINT' to have Control-C cancel the
+    # app the same way.
+    CANCEL_SIGNALS = ()
+
+    # Seconds main() has to return after a cancel signal, or None to
+    # wait forever.
+    shutdown_grace_period = 10.0
+
+    # Set when a cancel signal arrives
+    cancelled = False
+
+    # The number of the cancel signal received, or None
+    cancel_signal = None
+
+    # If true, --jobs uses worker processes instead of threads
+    fan_out_processes = False
+
+    # If true, the output for each item is collected and written in
+    # the same order as the arguments.  If false, output is written
+    # as soon as it is produced.
+    preserve_output_order = True
+
     def handle_interrupt(self):
         """Called when the program is interrupted via Control-C
         or SIGINT.  Returns exit code.
@@ -205,6 +2205,20 @@ class CommandLineApp(object):
         sys.stderr.write('Canceled by user.\n')
         return 1
 
+    def handle_signal(self, signum):
+        """Called when one of the CANCEL_SIGNALS arrives while the app
+        is running.
+
+        The default implementation calls a method named for the
+        signal, such as handle_sigterm() or handle_sighup(), if the
+        application defines one.
+        """
+        name = self._cancel_signal_names.get(signum, '')
+        callback = getattr(self, 'handle_%s' % name.lower(), None)
+        if callback is not None:
+            callback()
+        return
+
     def handle_main_exception(self, err):
         """Invoked when there is an error in the main() method.
         """
@@ -259,8 +2273,12 @@ class CommandLineApp(object):
         else:
             to_print = unicode(msg, 'utf-8').encode('ascii', 'replace')
         output.write(to_print)
+        self.status_bytes_written += len(to_print)
         return
 
+    # The number of bytes written by status_message()
+    status_bytes_written = 0
+
     def status_message(self, msg='', verbose_level=1, error=False, newline=True):
         """Print a status message to output.
 
@@ -285,14 +2303,295 @@ class CommandLineApp(object):
             self._status_message(msg, output)
             if newline:
                 output.write('\n')
+                self.status_bytes_written += 1
             # some log mechanisms don't have a flush method
             if hasattr(output, 'flush'):
                 output.flush()
         return
 
-    def error_message(self, msg=''):
-        'Print a message as an error.'
-        self.status_message('ERROR: %s\n' % msg, verbose_level=0, error=True)
+    def error_message(self, msg=''):
+        'Print a message as an error.'
+        self.status_message('ERROR: %s\n' % msg, verbose_level=0, error=True)
+        return
+
+    ## INPUT
+
+    # Number of bytes read at a time from input files
+    INPUT_BUFFER_SIZE = 1024 * 1024
+
+    def open_input(self, filename):
+        """Open an input file for reading.
+
+        The name ``-`` means standard input.  Files compressed with
+        gzip, bzip2, or xz (when :mod:`lzma` is available) are
+        decompressed as they are read.
+        """
+        if filename == '-':
+            # Closing the stream returned does not close standard input.
+            magic = _read_magic(sys.stdin)
+            return _PeekedStream(sys.stdin, magic, self.INPUT_BUFFER_SIZE,
+                                 _get_decompressor_factory(magic, filename),
+                                 close_stream=False)
+        return _open_compressed_file(filename, self.INPUT_BUFFER_SIZE)
+
+    def iter_input_chunks(self, filenames=(), chunk_size=None):
+        """Generate blocks of up to chunk_size bytes read from each of
+        the named files in turn, or from standard input if no names are
+        given.
+
+        Uncompressed regular files are memory mapped instead of being
+        read through a file buffer.
+        """
+        import mmap
+        chunk_size = chunk_size or self.INPUT_BUFFER_SIZE
+        for filename in (filenames or ('-',)):
+            f = self.open_input(filename)
+            try:
+                if isinstance(f, file):
+                    size = os.fstat(f.fileno()).st_size
+                else:
+                    size = 0
+                if size:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        for offset in xrange(0, size, chunk_size):
+                            yield data[offset:offset + chunk_size]
+                    finally:
+                        data.close()
+                else:
+                    while True:
+                        chunk = f.read(chunk_size)
+                        if not chunk:
+                            break
+                        yield chunk
+            finally:
+                f.close()
+        return
+
+    def iter_input_records(self, filenames=(), separator='\n'):
+        """Generate the records in each of the named files, or in
+        standard input if no names are given.
+
+        Records end with separator, which is included in the value
+        produced, the same way iterating over a file produces lines.
+        The last record of a file may not have a separator.
+        """
+        for filename in (filenames or ('-',)):
+            remainder = ''
+            for chunk in self.iter_input_chunks((filename,)):
+                records = (remainder + chunk).split(separator)
+                remainder = records.pop()
+                for record in records:
+                    yield record + separator
+            if remainder:
+                yield remainder
+        return
+
+    ## OUTPUT
+
+    # Number of bytes buffered before writing to the --output file
+    OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+    # The name given with --output, and the file opened for it when
+    # main() is run or get_output() is first called
+    output_filename = None
+    output_file = None
+
+    # Guards opening the --output file
+    _output_file_lock = threading.Lock()
+
+    # True while standard output is sent to the --output file
+    _output_redirected = False
+
+    def get_output(self):
+        """Return the stream main() should write its results to.
+
+        This is the file given with --output, or standard output.
+        While main() runs, standard output is sent to the --output
+        file, so anything printed is written there as well.
+        """
+        if self.output_filename is None or self._output_redirected:
+            return sys.stdout
+        return self._open_output_file()
+
+    def _open_output_file(self):
+        "Return the --output file, opening it the first time."
+        self._output_file_lock.acquire()
+        try:
+            if self.output_file is None:
+                self.output_file = _AtomicOutputFile(self.output_filename,
+                                                     self.OUTPUT_BUFFER_SIZE)
+        finally:
+            self._output_file_lock.release()
+        return self.output_file
+
+    def _call_with_output(self, func, *args):
+        """Call func with standard output sent to the --output file, if
+        one was given, and return its result.
+        """
+        if self.output_filename is None:
+            return func(*args)
+        original_stdout = sys.stdout
+        sys.stdout = self._open_output_file()
+        self._output_redirected = True
+        try:
+            return func(*args)
+        finally:
+            self._output_redirected = False
+            sys.stdout = original_stdout
+
+    def _close_output(self, exit_code):
+        """Replace the --output file if the program succeeded, and
+        throw away the new contents if it did not.  Returns the exit
+        code, which is changed to 1 if the file cannot be written.
+        """
+        output_file = self.output_file
+        if output_file is None or output_file.closed:
+            return exit_code
+        if _exit_status(exit_code) != 0:
+            output_file.discard()
+            return exit_code
+        try:
+            output_file.commit()
+        except (IOError, OSError), err:
+            self.error_message('Could not write %s: %s' %
+                               (output_file.filename, err))
+            exit_code = 1
+        return exit_code
+
+    ## PROGRESS
+
+    # How many times per second progress is redrawn on a terminal
+    PROGRESS_REFRESH_RATE = 10
+
+    # Seconds between progress lines when output is not a terminal
+    PROGRESS_LOG_INTERVAL = 10.0
+
+    def start_progress(self, total=None, label=None):
+        """Return a Progress to track a task with total items.
+
+        The progress is written to stderr while the verbose level is at
+        least 1, so --quiet turns it off.  Call finish() on the result,
+        or use it in a with statement, when the task is done.
+        """
+        if label is None:
+            label = self._app_name
+        progress = Progress(total, label, sys.stderr)
+        if self.verbose_level >= 1:
+            if progress._is_tty:
+                progress.start(1.0 / self.PROGRESS_REFRESH_RATE)
+            else:
+                progress.start(self.PROGRESS_LOG_INTERVAL)
+        return progress
+
+    ## RESOURCE USAGE
+
+    # When and how much CPU time had been used when run() started
+    _run_start_times = None
+
+    # The report produced by --stats or --stats-json
+    resource_usage = None
+
+    def get_resource_usage(self):
+        """Return a dictionary describing the resources used since run()
+        started.
+
+        The times are in seconds.  The peak resident set size is in
+        kilobytes, and is None on platforms where it is not available,
+        as is the number of garbage collections.
+        """
+        start_time, start_cpu = self._run_start_times or (time.time(),
+                                                          os.times())
+        end_cpu = os.times()
+        usage = {
+            'app': self._app_name,
+            'wall_time': time.time() - start_time,
+            'user_time': end_cpu[0] - start_cpu[0],
+            'system_time': end_cpu[1] - start_cpu[1],
+            'children_user_time': end_cpu[2] - start_cpu[2],
+            'children_system_time': end_cpu[3] - start_cpu[3],
+            'max_rss_kb': None,
+            'gc_collections': None,
+            'status_bytes': self.status_bytes_written,
+            }
+        try:
+            import resource
+        except ImportError:
+            pass
+        else:
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == 'darwin':
+                max_rss //= 1024
+            usage['max_rss_kb'] = max_rss
+        if hasattr(gc, 'get_stats'):
+            usage['gc_collections'] = sum([ s['collections']
+                                            for s in gc.get_stats() ])
+        return usage
+
+    def _report_resource_usage(self, exit_code):
+        """Save the resource usage report, and print it to stderr if
+        the app is going to exit.
+        """
+        self.resource_usage = usage = self.get_resource_usage()
+        usage['exit_code'] = _exit_status(exit_code)
+        if not self.force_exit:
+            return
+        if self.stats_format == 'json':
+            import json
+            report = json.dumps(usage, sort_keys=True)
+        else:
+            def show(value, format):
+                if value is None:
+                    return 'n/a'
+                return format % value
+            report = ('%s: wall %.3fs user %.3fs sys %.3fs maxrss %s '
+                      'gc %s status %dB exit %d' % (
+                    usage['app'], usage['wall_time'], usage['user_time'],
+                    usage['system_time'], show(usage['max_rss_kb'], '%dKB'),
+                    show(usage['gc_collections'], '%d'),
+                    usage['status_bytes'], usage['exit_code']))
+        sys.stdout.flush()
+        sys.stderr.write(report + '\n')
+        sys.stderr.flush()
+        return
+
+    # The memory snapshot taken after the options were processed, for
+    # --trace-malloc-diff
+    _options_memory_snapshot = None
+
+    def _take_memory_snapshot(self):
+        "Return a tracemalloc snapshot, ignoring tracemalloc itself."
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ])
+
+    def _report_memory_allocations(self):
+        """Report the source lines that allocated the most memory, for
+        --trace-malloc.
+        """
+        count = self.trace_malloc_count
+        snapshot = self._take_memory_snapshot()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        lines = [ 'Top %d memory allocation sites:' % count ]
+        for stat in snapshot.statistics('lineno')[:count]:
+            lines.append('    %s' % stat)
+        if self._options_memory_snapshot is not None:
+            lines.append('Top %d memory allocation changes in main():' % count)
+            for stat in snapshot.compare_to(self._options_memory_snapshot,
+                                            'lineno')[:count]:
+                lines.append('    %s' % stat)
+        report = '\n'.join(lines)
+        if self.trace_malloc_filename:
+            output = open(self.trace_malloc_filename, 'wt')
+            try:
+                output.write(report + '\n')
+            finally:
+                output.close()
+        else:
+            self.status_message(report, verbose_level=0, error=True)
         return
 
     ## DEFAULT OPTIONS
@@ -316,6 +2615,64 @@ class CommandLineApp(object):
         self._run_main = False
         return
 
+    jobs = 1
+    def option_handler_jobs(self, num):
+        """Process up to num arguments in parallel.
+        """
+        self.jobs = int(num)
+        return
+
+    def option_handler_output(self, filename):
+        """Write output to filename, replacing it only if the program
+        succeeds.  Names ending in .gz, .bz2, or .xz are compressed.
+        """
+        if filename != '-':
+            self.output_filename = filename
+        return
+
+    stats_format = None
+    def option_handler_stats(self):
+        """Report resource usage when the program exits.
+        """
+        self.stats_format = 'text'
+        return
+
+    def option_handler_stats_json(self):
+        """Report resource usage as JSON when the program exits.
+        """
+        self.stats_format = 'json'
+        return
+
+    trace_malloc_count = 0
+    _started_tracemalloc = False
+    def option_handler_trace_malloc(self, count):
+        """Trace memory allocations, and report the count source lines
+        that allocated the most memory when the program exits.
+        """
+        if tracemalloc is None:
+            raise RuntimeError('Tracing memory allocations requires '
+                               'the tracemalloc module')
+        self.trace_malloc_count = int(count)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        return
+
+    trace_malloc_diff = False
+    def option_handler_trace_malloc_diff(self):
+        """With --trace-malloc, also report the lines that allocated
+        the most memory while main() ran.
+        """
+        self.trace_malloc_diff = True
+        return
+
+    trace_malloc_filename = None
+    def option_handler_trace_malloc_file(self, filename):
+        """Write the --trace-malloc report to filename.
+        """
+        self.trace_malloc_filename = filename
+        return
+
     def option_handler_quiet(self):
         'Turn on quiet mode.'
         self.verbose_level = 0
@@ -350,70 +2707,835 @@ class CommandLineApp(object):
         This method should not need to be overridden, if the main()
         method is defined.
         """
+        if self._is_completion_request():
+            return self._run_completion_request()
+
+        self._run_start_times = (time.time(), os.times())
+        hooks = self._get_hooks()
+        tracer = self._get_tracer()
+        if tracer:
+            tracer.start_span('run', {
+                    'app.name': self._app_name,
+                    'app.version': self._app_version or '',
+                    'process.command_args': list(self.command_line_options),
+                    })
+            tracer.start_span('parse_options')
+
         # Process the options supported and given
         options = {}
         for info in self.supported_options:
             options[ info.switch ] = info
-        parsed_options, remaining_args = self.call_getopt(self.command_line_options,
-                                                         self.supported_options)
+        try:
+            parsed_options, remaining_args = self.call_getopt(
+                self.command_line_options, self.supported_options)
+        except (getopt.error, SystemExit), err:
+            # call_getopt() has shown the help.  Finish the run before
+            # passing the error on.
+            if isinstance(err, SystemExit):
+                exit_code = err.code
+            else:
+                exit_code = 1
+            if tracer:
+                tracer.end_open_spans('Invalid options')
+                self._finish_trace(tracer, exit_code)
+            if hooks['exit']:
+                self._call_hooks(hooks['exit'], exit_code)
+            raise
         exit_code = 0
+        self._previous_signal_handlers = self._install_signal_handlers()
         try:
+            invoked_options = self.get_configured_options()
             for switch, option_value in parsed_options:
-                opt_def = options[switch]
-                opt_def.invoke(self, option_value)
+                invoked_options.append( (options[switch], option_value) )
+            # Start tracing memory before any other option handlers run.
+            invoked_options.sort(key=lambda (o, v):
+                                 o.method_name != 'option_handler_trace_malloc')
+            violations = self.check_option_constraints(invoked_options)
+            if violations:
+                self.show_help('\n        '.join(violations))
+                exit_code = 1
+                # Do not run any option handlers or main()
+                invoked_options = []
+                self._run_main = False
+            invoked_options = self._accumulate_options(invoked_options)
+            if tracer:
+                tracer.end_span()
+            before_option = hooks['before_option']
+            after_option = hooks['after_option']
+            for opt_def, option_value in invoked_options:
+                if before_option:
+                    self._call_hooks(before_option, opt_def, option_value)
+                if tracer:
+                    tracer.start_span('option', {'option.switch': opt_def.switch})
+                self._get_option_invoker(opt_def)(option_value)
+                if tracer:
+                    tracer.end_span()
+                if after_option:
+                    self._call_hooks(after_option, opt_def, option_value)
+
+            if self.trace_malloc_count and self.trace_malloc_diff:
+                self._options_memory_snapshot = self._take_memory_snapshot()
 
             # Perform the primary action for this application,
             # unless one of the options has disabled it.
-            if self._run_main:
+            if self._run_main and self.SUBCOMMANDS:
+                exit_code = self._run_subcommand(remaining_args)
+
+            elif self._run_main:
                 main_args = tuple(remaining_args)
 
-                # We could just call main() and catch a TypeError,
-                # but that would not let us differentiate between
-                # application errors and a case where the user
-                # has not passed us enough arguments.  So, we check
-                # the argument count ourself.
-                num_args_ok = False
-                argspec = inspect.getargspec(self.main)
-                defaults = argspec[3]
-                # Arguments with defaults are not required, so subtract them
-                expected_arg_count = len(argspec[0]) - 1 - len(defaults or [])
-
-                if argspec[1] is not None:
-                    num_args_ok = True
-                    if len(argspec[0]) > 1:
-                        num_args_ok = (len(main_args) >= expected_arg_count)
-                elif len(main_args) == expected_arg_count:
-                    num_args_ok = True
-
-                if num_args_ok:
-                    exit_code = self.main(*main_args)
-                else:
+                if tracer:
+                    tracer.start_span('validate_arguments',
+                                      {'arguments.count': len(main_args)})
+                num_args_ok = self._main_args_ok(main_args)
+                if tracer:
+                    tracer.end_span()
+
+                if not num_args_ok:
                     self.show_help('Incorrect arguments.')
                     exit_code = 1
+                else:
+                    if hooks['before_main']:
+                        self._call_hooks(hooks['before_main'], main_args)
+                    if tracer:
+                        tracer.start_span('main')
+                    if self.cache_results:
+                        exit_code = self._call_with_output(
+                            self._call_main_cached, main_args,
+                            invoked_options)
+                    else:
+                        exit_code = self._call_with_output(self._call_main,
+                                                           main_args)
+                    if tracer:
+                        tracer.end_span()
+                    if hooks['after_main']:
+                        self._call_hooks(hooks['after_main'], exit_code)
+
+        except ShutdownDeadlineExceeded, err:
+            if tracer:
+                tracer.end_open_spans(str(err))
+            self.error_message(str(err))
+            exit_code = 128 + self.cancel_signal
 
         except KeyboardInterrupt:
+            if tracer:
+                tracer.end_open_spans('Interrupted')
             exit_code = self.handle_interrupt()
 
         except SystemExit, msg:
+            if tracer:
+                tracer.end_open_spans()
             exit_code = msg.args[0]
 
         except Exception, err:
+            if tracer:
+                tracer.end_open_spans(str(err) or err.__class__.__name__)
+            if hooks['exception']:
+                self._call_hooks(hooks['exception'], err)
             exit_code = self.handle_main_exception(err)
 
+        self._close_event_loop()
+        self._restore_signal_handlers(self._previous_signal_handlers)
+        exit_code = self._close_output(exit_code)
+
+        if tracer:
+            self._finish_trace(tracer, exit_code)
+
+        if self.trace_malloc_count:
+            self._report_memory_allocations()
+
+        if self.stats_format:
+            self._report_resource_usage(exit_code)
+
+        if hooks['exit']:
+            self._call_hooks(hooks['exit'], exit_code)
+
+        self._flush_output()
+        if self.force_exit:
+            sys.exit(exit_code)
+        return exit_code
+
+    def _finish_trace(self, tracer, exit_code):
+        "End the spans of the run and export them."
+        try:
+            tracer.finish(self, exit_code)
+        except (IOError, OSError), err:
+            self.error_message('Could not export trace: %s' % err)
+        return
+
+    def check_option_constraints(self, invoked_options):
+        """Check the (OptionDef, value) pairs in invoked_options
+        against the constraints of the options and the
+        EXCLUSIVE_OPTION_GROUPS.
+
+        Returns a list of messages describing every problem found.
+        When help is requested, only the values given are checked.
+        """
+        violations = []
+        used = {}
+        help_requested = False
+        for opt_def, option_value in invoked_options:
+            used.setdefault(opt_def.get_alias_key(self), opt_def)
+            violations.extend(opt_def.check_value(option_value))
+            if opt_def.method_name in _HELP_OPTION_HANDLERS:
+                help_requested = True
+        if help_requested:
+            return violations
+
+        # The key and preferred switch of each option, by name
+        options_by_name = {}
+        switches = {}
+        for opt_def in self.supported_options:
+            key = opt_def.get_alias_key(self)
+            options_by_name[opt_def.option_name] = key
+            current = switches.get(key)
+            if current is None or (opt_def.is_long and
+                                   not current.startswith('--')):
+                switches[key] = opt_def.switch
+        def lookup(name):
+            try:
+                return options_by_name[name.lstrip('-').replace('-', '_')]
+            except KeyError:
+                raise ValueError('Unknown option %r in constraints' % name)
+
+        checked = set()
+        for opt_def in self.supported_options:
+            key = opt_def.get_alias_key(self)
+            if key in checked:
+                continue
+            checked.add(key)
+            if key not in used:
+                if opt_def.required:
+                    violations.append('%s is required' % switches[key])
+                continue
+            for name in opt_def.requires:
+                if lookup(name) not in used:
+                    violations.append('%s requires %s' %
+                                      (used[key].switch, switches[lookup(name)]))
+            for name in opt_def.conflicts:
+                other = lookup(name)
+                if other in used:
+                    violations.append('%s cannot be used with %s' %
+                                      (used[key].switch, used[other].switch))
+
+        for group in self.EXCLUSIVE_OPTION_GROUPS:
+            given = [ used[lookup(name)].switch for name in group
+                      if lookup(name) in used ]
+            if len(given) > 1:
+                violations.append('Only one of %s can be used' %
+                                  ', '.join(given))
+        return violations
+
+    def _get_option_invoker(self, opt_def):
+        """Return the function that handles opt_def for this app,
+        binding it the first time it is needed.
+        """
+        try:
+            return self._option_invokers[opt_def]
+        except KeyError:
+            invoker = self._option_invokers[opt_def] = opt_def.bind(self)
+            return invoker
+
+    def _accumulate_options(self, invoked_options):
+        """Combine the values of each option that accumulates, so its
+        handler is only called once, where the option was first used.
+        """
+        combined = []
+        positions = {}
+        keys = {}
+        for item in invoked_options:
+            opt_def = item[0]
+            if not opt_def.accumulate:
+                combined.append(item)
+                continue
+            key = keys.get(opt_def)
+            if key is None:
+                key = keys[opt_def] = opt_def.get_alias_key(self)
+            position = positions.get(key)
+            if position is None:
+                positions[key] = len(combined)
+                if opt_def.accumulate == 'count':
+                    combined.append((opt_def, 1))
+                else:
+                    combined.append((opt_def, [item[1]]))
+            elif opt_def.accumulate == 'count':
+                first, count = combined[position]
+                combined[position] = (first, count + 1)
+            else:
+                combined[position][1].append(item[1])
+        return combined
+
+    def _main_args_ok(self, main_args):
+        "Are the arguments acceptable to main()?"
+        # We could just call main() and catch a TypeError,
+        # but that would not let us differentiate between
+        # application errors and a case where the user
+        # has not passed us enough arguments.  So, we check
+        # the argument count ourself.
+        num_args_ok = False
+        argspec = inspect.getargspec(self.main)
+        defaults = argspec[3]
+        # Arguments with defaults are not required, so subtract them
+        expected_arg_count = len(argspec[0]) - 1 - len(defaults or [])
+
+        if argspec[1] is not None:
+            num_args_ok = True
+            if len(argspec[0]) > 1:
+                num_args_ok = (len(main_args) >= expected_arg_count)
+        elif len(main_args) == expected_arg_count:
+            num_args_ok = True
+        return num_args_ok
+
+    def _call_main(self, main_args):
+        "Run the main part of the app and return its exit code."
+        if self._uses_main_item():
+            return self._run_main_items(main_args)
+        exit_code = self.main(*main_args)
+        if _is_coroutine_function(self.main):
+            exit_code = self._run_coroutine(exit_code)
+        return exit_code
+
+    def _call_main_cached(self, main_args, invoked_options):
+        """Run the main part of the app, or replay the output and exit
+        code saved from an earlier run with the same options, arguments,
+        and input files.
+        """
+        cache_filename = os.path.join(
+            _get_cache_dir(), 'results',
+            self._get_result_cache_key(main_args, invoked_options))
+        try:
+            cache_file = open(cache_filename, 'rb')
+            try:
+                exit_code, output = marshal.load(cache_file)
+            finally:
+                cache_file.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+        else:
+            # Mark the entry as recently used.
+            os.utime(cache_filename, None)
+            sys.stdout.write(output)
+            return exit_code
+
+        original_stdout = sys.stdout
+        sys.stdout = _TeeStream(original_stdout)
+        try:
+            exit_code = self._call_main(main_args)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = original_stdout
+        try:
+            _write_file_atomically(cache_filename,
+                                   marshal.dumps((exit_code, output)))
+            _prune_cache_dir(os.path.dirname(cache_filename),
+                             self.RESULT_CACHE_SIZE)
+        except (IOError, OSError, ValueError):
+            # The cache is only an optimization.
+            pass
+        return exit_code
+
+    def _get_result_cache_key(self, main_args, invoked_options):
+        """Return the name of the result cache entry for running the app
+        with the options and arguments.
+        """
+        import hashlib
+        cls = self.__class__
+        inputs = []
+        for filename in self.get_cache_input_files(*main_args):
+            try:
+                if self.RESULT_CACHE_HASH_INPUTS:
+                    input_file = open(filename, 'rb')
+                    try:
+                        signature = hashlib.sha1(input_file.read()).hexdigest()
+                    finally:
+                        input_file.close()
+                else:
+                    stat = os.stat(filename)
+                    signature = (stat.st_mtime, stat.st_size)
+            except (IOError, OSError):
+                signature = None
+            inputs.append( (os.path.abspath(filename), signature) )
+        key = (cls.__module__, cls.__name__, self._app_version,
+               [ (o.method_name, value) for o, value in invoked_options ],
+               list(main_args),
+               inputs,
+               )
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    _event_loop = None
+    def _run_coroutine(self, coro):
+        """Run a coroutine in the app's event loop and return its result.
+
+        If the user interrupts the program, the task is cancelled and
+        given a chance to clean up before KeyboardInterrupt is
+        re-raised to be handled by run().
+        """
+        if self._event_loop is None:
+            self._event_loop = asyncio.new_event_loop()
+        loop = self._event_loop
+        task = loop.create_task(coro)
+        try:
+            return loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            interrupt = sys.exc_info()
+            task.cancel()
+            try:
+                loop.run_until_complete(task)
+            except (asyncio.CancelledError, Exception):
+                pass
+            raise interrupt[0], interrupt[1], interrupt[2]
+
+    # Signal names by number, for the CANCEL_SIGNALS being handled
+    _cancel_signal_names = {}
+
+    def _install_signal_handlers(self):
+        """Handle the CANCEL_SIGNALS, and return the previous handlers so
+        they can be restored by _restore_signal_handlers().
+        """
+        self._cancel_signal_names = {}
+        previous_handlers = {}
+        for name in self.CANCEL_SIGNALS:
+            signum = getattr(signal, name, None)
+            if signum is None:
+                # Not supported on this platform
+                continue
+            try:
+                previous_handlers[signum] = signal.signal(
+                    signum, self._on_cancel_signal)
+            except ValueError:
+                # Signals can only be handled in the main thread.
+                break
+            self._cancel_signal_names[signum] = name
+        return previous_handlers
+
+    def _restore_signal_handlers(self, previous_handlers):
+        "Restore the signal handlers replaced by _install_signal_handlers()."
+        if self.cancelled and self.shutdown_grace_period is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        return
+
+    def _on_cancel_signal(self, signum, frame):
+        "Signal handler for the CANCEL_SIGNALS."
+        if self.cancelled:
+            raise ShutdownDeadlineExceeded('Received a second signal')
+        self.cancelled = True
+        self.cancel_signal = signum
+        if self.shutdown_grace_period is not None:
+            previous_handlers = self._previous_signal_handlers
+            if signal.SIGALRM not in previous_handlers:
+                previous_handlers[signal.SIGALRM] = signal.signal(
+                    signal.SIGALRM, self._on_shutdown_deadline)
+            signal.setitimer(signal.ITIMER_REAL, self.shutdown_grace_period)
+        self.handle_signal(signum)
+        return
+
+    def _on_shutdown_deadline(self, signum, frame):
+        "Signal handler for the end of the shutdown_grace_period."
+        raise ShutdownDeadlineExceeded('Did not stop within %s seconds' %
+                                       self.shutdown_grace_period)
+
+    def _flush_output(self):
+        """Make sure everything written to the standard streams and the
+        --output file is output.
+        """
+        streams = [sys.stdout, sys.stderr]
+        if self.output_file is not None and not self.output_file.closed:
+            streams.append(self.output_file)
+        for stream in streams:
+            try:
+                stream.flush()
+            except (AttributeError, IOError, ValueError):
+                pass
+        return
+
+    def _close_event_loop(self):
+        """Shut down the event loop, if one was created.
+        """
+        if self._event_loop is not None:
+            self._event_loop.close()
+            self._event_loop = None
+        return
+
+    ## CONFIGURATION
+
+    # Values for options that do not take an argument
+    _CONFIG_TRUE_VALUES = ('1', 'yes', 'true', 'on')
+    _CONFIG_FALSE_VALUES = ('0', 'no', 'false', 'off', '')
+
+    def get_configured_options(self):
+        """Return the option values given by CONFIG_FILES and the
+        environment.
+
+        Returns a list of (OptionDef, value) tuples, in the order the
+        option handlers should be invoked.
+        """
+        options = {}
+        for option in self.supported_options:
+            options[option.option_name] = option
+        configured = []
+
+        section = self.CONFIG_SECTION or os.path.splitext(self._app_name)[0]
+        for filename in self.CONFIG_FILES:
+            filename = os.path.expanduser(filename)
+            if not os.path.exists(filename):
+                continue
+            values = _load_config_file(filename).get(section, {})
+            for name, value in sorted(values.items()):
+                option = options.get(name.replace('-', '_'))
+                if option is None:
+                    raise ValueError('Unknown option "%s" in %s' %
+                                     (name, filename))
+                self._add_configured_option(configured, option, value,
+                                            filename)
+
+        if self.ENVIRONMENT_PREFIX:
+            for name, option in sorted(options.items()):
+                env_name = '%s_%s' % (self.ENVIRONMENT_PREFIX, name.upper())
+                if env_name in os.environ:
+                    self._add_configured_option(configured, option,
+                                                os.environ[env_name], env_name)
+        return configured
+
+    def _add_configured_option(self, configured, option, value, source):
+        """Convert a value from a configuration file or the environment
+        to an option argument, and add it to the list of configured
+        options.
+        """
+        if not option.arg_name:
+            if not isinstance(value, bool):
+                flag = str(value).lower()
+                if flag not in self._CONFIG_TRUE_VALUES + self._CONFIG_FALSE_VALUES:
+                    raise ValueError('%s does not take an argument (%s)' %
+                                     (option.switch, source))
+                value = flag in self._CONFIG_TRUE_VALUES
+            if value:
+                configured.append( (option, '') )
+            return
+        if isinstance(value, (list, tuple)):
+            value = option.SPLIT_PARAM_CHAR.join([ str(v) for v in value ])
+        elif not isinstance(value, basestring):
+            value = str(value)
+        configured.append( (option, value) )
+        return
+
+    ## SHELL COMPLETION
+
+    def _is_completion_request(self):
+        "Was the app run by one of the shell completion scripts?"
+        return self.command_line_options[:1] in ([self.COMPLETION_SWITCH],
+                                                 [self.COMPLETION_SCRIPT_SWITCH])
+
+    def _run_completion_request(self):
+        """Print the response for the shell completion scripts and
+        return the exit code.
+        """
+        switch = self.command_line_options[0]
+        args = self.command_line_options[1:]
+        exit_code = 0
+        if switch == self.COMPLETION_SWITCH:
+            for candidate, description in self.get_completions(args):
+                if description:
+                    print '%s\t%s' % (candidate, description)
+                else:
+                    print candidate
+        else:
+            try:
+                print self.get_completion_script(*args)
+            except (TypeError, ValueError), err:
+                self.error_message(str(err))
+                exit_code = 1
         if self.force_exit:
             sys.exit(exit_code)
         return exit_code
 
+    def get_completions(self, words):
+        """Return the candidates for completing a command line.
+
+        The words are the arguments to the program, up to and including
+        the partial word being completed.  Returns a sorted list of
+        (candidate, description) tuples.  An empty list means the shell
+        should fall back to its default completion, usually file names.
+        """
+        # bash splits "--option=value" into separate words
+        joined = []
+        for word in words:
+            if joined and joined[-1].startswith('--') and \
+                    (word == '=' or joined[-1].endswith('=')):
+                joined[-1] += word
+            else:
+                joined.append(word)
+        words = joined or ['']
+        partial = words[-1]
+
+        options = {}
+        for option in self.supported_options:
+            options[option.switch] = option
+
+        # Find where the options stop, the way getopt does, and whether
+        # the last complete word is an option waiting for its argument.
+        expecting_value = False
+        for index, word in enumerate(words[:-1]):
+            if expecting_value:
+                expecting_value = False
+            elif word == '--':
+                return self._get_argument_completions(words[index+1:])
+            elif not word.startswith('-') or word == '-':
+                return self._get_argument_completions(words[index:])
+            elif word.startswith('--'):
+                option = options.get(word)
+                expecting_value = bool(option and option.arg_name)
+            else:
+                for position, char in enumerate(word[1:]):
+                    option = options.get('-' + char)
+                    if option and option.arg_name:
+                        expecting_value = (position == len(word) - 2)
+                        break
+
+        if expecting_value or (partial.startswith('--') and '=' in partial):
+            return []
+        if partial.startswith('-'):
+            return self._get_option_completions(partial)
+        return self._get_argument_completions([partial])
+
+    def _get_option_completions(self, partial):
+        "Return the completion candidates for a partial option switch."
+        candidates = []
+        for names, options in self._group_option_aliases():
+            description = (options[0].help or '').split('\n')[0]
+            for option in options:
+                candidate = option.switch
+                if option.is_long and option.arg_name:
+                    candidate += '='
+                if candidate.startswith(partial):
+                    candidates.append( (candidate, description) )
+        candidates.sort()
+        return candidates
+
+    def _get_argument_completions(self, words):
+        """Return the completion candidates once the options are done.
+
+        The first word is the first argument after the options, and the
+        last word is the partial word being completed.
+        """
+        if not self.SUBCOMMANDS:
+            return []
+        if len(words) == 1:
+            return [ (name, '') for name in sorted(self.SUBCOMMANDS)
+                     if name.startswith(words[0]) ]
+        app_class = self.get_subcommand_class(words[0])
+        if app_class is None:
+            return []
+        app = app_class([self.COMPLETION_SWITCH], parent_app=self)
+        return app.get_completions(words[1:])
+
+    def get_completion_script(self, shell='bash'):
+        """Return a script to enable command line completion for the app
+        in the named shell (bash, zsh, or fish).
+
+        The script calls the app with COMPLETION_SWITCH to find the
+        candidates each time the user asks for completion.
+        """
+        try:
+            template = _COMPLETION_SCRIPTS[shell]
+        except KeyError:
+            raise ValueError('Unsupported shell "%s"' % shell)
+        name = self._app_name
+        function = '_' + ''.join([ c.isalnum() and c or '_' for c in name ])
+        return template % { 'name': name,
+                            'function': function,
+                            'switch': self.COMPLETION_SWITCH,
+                            }
+
+    def get_subcommand_class(self, name):
+        """Return the class for the subcommand name, importing it if
+        needed, or None if there is no such command.
+        """
+        app_class = self.SUBCOMMANDS.get(name)
+        if isinstance(app_class, basestring):
+            app_class = _import_class(app_class)
+        return app_class
+
+    def _run_subcommand(self, args):
+        """Run the subcommand named by the first argument with the rest
+        of the arguments, and return its exit code.
+        """
+        if not args:
+            self.show_help('No command given.')
+            return 1
+        name = args[0]
+        app_class = self.get_subcommand_class(name)
+        if app_class is None:
+            self.show_help('Unknown command "%s".' % name)
+            return 1
+        app = app_class(list(args[1:]), parent_app=self)
+        app._app_name = '%s %s' % (self._app_name, name)
+        app.force_exit = False
+        return app.run()
+
+    @classmethod
+    def _uses_main_item(cls):
+        "Has the application defined main_item()?"
+        return cls.main_item is not None
+
+    def _run_main_items(self, args):
+        """Call main_item() for each argument and return the highest
+        exit code.
+        """
+        if self.jobs > 1 and len(args) > 1 and \
+                not _is_coroutine_function(self.main_item):
+            exit_codes = self._run_main_items_in_pool(args)
+        else:
+            exit_codes = [ self._call_main_item(arg) for arg in args ]
+        return max([ _exit_status(c) for c in exit_codes ] or [0])
+
+    def _run_main_items_in_pool(self, args):
+        """Call main_item() for each argument using a pool of
+        self.jobs workers, and return the list of exit codes.
+        """
+        global _fan_out_app
+        if self.fan_out_processes:
+            from multiprocessing import Pool
+        else:
+            from multiprocessing.pool import ThreadPool as Pool
+
+        # Anything buffered would be written again by forked workers.
+        sys.stdout.flush()
+        original_streams = (sys.stdout, sys.stderr)
+        if self._capture_item_output():
+            # Workers capture their output through these wrappers, so
+            # it can be written by this process one item at a time.
+            # They are installed before the pool starts so worker
+            # processes inherit them.
+            sys.stdout = _ThreadLocalStream(sys.stdout)
+            sys.stderr = _ThreadLocalStream(sys.stderr)
+        if self.preserve_output_order:
+            results_iter_name = 'imap'
+        else:
+            results_iter_name = 'imap_unordered'
+
+        _fan_out_app = self
+        pool = Pool(self.jobs)
+        try:
+            exit_codes = []
+            results = getattr(pool, results_iter_name)(_fan_out_worker, args)
+            while True:
+                try:
+                    exit_code, output, error_output = results.next(
+                        _POOL_WAIT_TIMEOUT)
+                except StopIteration:
+                    break
+                original_streams[0].write(output)
+                original_streams[1].write(error_output)
+                exit_codes.append(exit_code)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _fan_out_app = None
+            sys.stdout, sys.stderr = original_streams
+            sys.stdout.flush()
+        return exit_codes
+
+    def _capture_item_output(self):
+        """Should the output of each item be collected by the workers
+        and written by the main process?  This is needed to write it
+        in argument order, and to write it to the --output file, which
+        worker processes cannot share.
+        """
+        return self.preserve_output_order or self._output_redirected
+
+    def _call_main_item_in_worker(self, arg):
+        """Call main_item() from a pool worker.
+
+        Returns a tuple containing the exit code and any output
+        captured for the item.
+        """
+        capture = self._capture_item_output()
+        if capture:
+            sys.stdout.start_capture()
+            sys.stderr.start_capture()
+        try:
+            exit_code = self._call_main_item(arg)
+        finally:
+            if capture:
+                output = sys.stdout.stop_capture()
+                error_output = sys.stderr.stop_capture()
+            else:
+                output = error_output = ''
+                sys.stdout.flush()
+        return (exit_code, output, error_output)
+
+    def _call_main_item(self, arg):
+        """Call main_item() for one argument, handling errors the way
+        run() does for main().
+        """
+        try:
+            exit_code = self.main_item(arg)
+            if _is_coroutine_function(self.main_item):
+                exit_code = self._run_coroutine(exit_code)
+            return exit_code
+        except SystemExit, msg:
+            return msg.code
+        except Exception, err:
+            return self.handle_main_exception(err)
+
     def scan_for_options(self):
-        "Scan through the inheritence hierarchy to find option handlers."
-        options = []
+        """Scan through the inheritence hierarchy to find option handlers.
+
+        The results are saved on the class, so only the first instance
+        of each application class pays for the scan.
+        """
+        return list(self._get_option_table())
 
-        methods = inspect.getmembers(self.__class__, inspect.ismethod)
+    @classmethod
+    def _get_option_table(cls):
+        "Return the tuple of OptionDefs for the class, scanning if needed."
+        cached = cls.__dict__.get('_option_table')
+        if cached is not None:
+            return cached
+
+        options = {}
+
+        if cls.SCAN_OPTION_HANDLERS:
+            methods = inspect.getmembers(cls, inspect.ismethod)
+        else:
+            methods = [ (name, getattr(cls, name))
+                        for name in CommandLineApp.__dict__
+                        if name.startswith(OptionDef.OPTION_HANDLER_PREFIX) ]
         for method_name, method in methods:
-            if method_name.startswith(OptionDef.OPTION_HANDLER_PREFIX):
-                options.append(OptionDef(method_name, method))
+            if not method_name.startswith(OptionDef.OPTION_HANDLER_PREFIX):
+                continue
+            if method_name == 'option_handler_jobs' and \
+                    method.im_func is CommandLineApp.option_handler_jobs.im_func \
+                    and (not cls._uses_main_item() or
+                         _is_coroutine_function(cls.main_item)):
+                # The default --jobs only means something for apps
+                # using a main_item() that is not a coroutine.  Apps
+                # defining their own option_handler_jobs() keep it.
+                continue
+            if tracemalloc is None and \
+                    method_name.startswith('option_handler_trace_malloc'):
+                # Memory allocations cannot be traced without tracemalloc.
+                continue
+            option = OptionDef(method_name, method)
+            options[option.option_name] = option
 
-        return options
+        # Options declared in subclasses replace those of base classes.
+        for klass in reversed(inspect.getmro(cls)):
+            for attribute, value in klass.__dict__.items():
+                if not isinstance(value, Option):
+                    continue
+                value.attribute = attribute
+                for name in (value.name,) + value.aliases:
+                    options[name] = _DeclaredOptionDef(value, name, cls)
+
+        options = [ options[name] for name in sorted(options) ]
+        cls._option_table = tuple(options)
+        return cls._option_table
 
     def call_getopt(self, command_line_options, supported_options):
         "Parse the command line options."
@@ -447,20 +3569,7 @@ class CommandLineApp(object):
         """Return a sequence of tuples containing
         (option_names, option_defs)
         """
-        # Figure out which options are aliases
-        option_aliases = {}
-        for option in self.supported_options:
-            method = getattr(self, option.method_name)
-            existing_aliases = option_aliases.setdefault(method, [])
-            existing_aliases.append(option)
-
-        # Sort the groups in order
-        grouped_options = []
-        for options in option_aliases.values():
-            names = [ o.option_name for o in options ]
-            grouped_options.append( (names, options) )
-        grouped_options.sort()
-        return grouped_options
+        return _group_option_aliases(self, self.supported_options)
 
     def _get_option_identifier_text(self, options):
         """Return the option identifier text.
@@ -482,17 +3591,7 @@ class CommandLineApp(object):
         """Look at the arguments to main to see what the program accepts,
         and build a syntax string explaining how to pass those arguments.
         """
-        syntax_parts = []
-        argspec = inspect.getargspec(self.main)
-        args = argspec[0]
-        if len(args) > 1:
-            for arg in args[1:]:
-                syntax_parts.append(arg)
-        if argspec[1]:
-            syntax_parts.append(argspec[1])
-            syntax_parts.append('[' + argspec[1] + '...]')
-        syntax = ' '.join(syntax_parts)
-        return syntax
+        return _get_arguments_syntax(self)
 
     def get_simple_syntax_help_string(self):
         """Return syntax statement.
@@ -557,6 +3656,14 @@ class CommandLineApp(object):
             buffer.write('\n\nARGUMENTS:\n\n')
             buffer.write(main_help_text)
 
+        if self.SUBCOMMANDS:
+            buffer.write('\nCOMMANDS:\n\n')
+            for name in sorted(self.SUBCOMMANDS):
+                buffer.write('    %s\n' % name)
+                app_class = self.get_subcommand_class(name)
+                description = (inspect.getdoc(app_class) or '').split('\n\n')[0]
+                buffer.write(self._format_help_text(description, '        '))
+
         buffer.write('\nOPTIONS:\n\n')
 
         grouped_options = self._group_option_aliases()
@@ -573,6 +3680,456 @@ class CommandLineApp(object):
             buffer.write(self.EXAMPLES_DESCRIPTION)
         return buffer.getvalue()
 
+    @classmethod
+    def render_help(cls, format='man'):
+        """Return the full help for the application as a document in
+        format ('man', 'markdown', or 'html').
+
+        The document is built from the class docstring, the arguments
+        and docstring of main(), the option table, and
+        EXAMPLES_DESCRIPTION, without creating an instance, so none of
+        the setup hooks or option handlers run.
+        """
+        try:
+            renderer = _HELP_RENDERERS[format][0]
+        except KeyError:
+            raise ValueError('Unsupported help format "%s"' % format)
+        return renderer(cls._get_help_parts())
+
+    @classmethod
+    def _get_help_name(cls):
+        """Return the name of the program, or the name of the class if
+        it does not set _app_name.
+        """
+        if cls._app_name is CommandLineApp._app_name:
+            return cls.__name__
+        return cls._app_name
+
+    @classmethod
+    def _get_help_parts(cls):
+        "Return a dictionary with the pieces of the help for the class."
+        name = cls._get_help_name()
+        title = name
+        if cls._app_version:
+            title = '%s version %s' % (name, cls._app_version)
+        options = []
+        for names, option_defs in _group_option_aliases(
+                cls, cls._get_option_table()):
+            options.append(([ o.get_switch_text() for o in option_defs ],
+                            _get_paragraphs(option_defs[0].help)))
+        commands = []
+        for command in sorted(cls.SUBCOMMANDS):
+            app_class = cls.SUBCOMMANDS[command]
+            if isinstance(app_class, basestring):
+                app_class = _import_class(app_class)
+            commands.append((command,
+                             (_get_paragraphs(inspect.getdoc(app_class))
+                              or [''])[0]))
+        return {
+            'name': name,
+            'title': title,
+            'description': _get_paragraphs(inspect.getdoc(cls)),
+            'synopsis': ('[options] %s' % _get_arguments_syntax(cls)).strip(),
+            'arguments': _get_paragraphs(inspect.getdoc(cls.main)),
+            'commands': commands,
+            'options': options,
+            'examples': cls.EXAMPLES_DESCRIPTION.strip('\n'),
+            }
+
+
+
+# Open sqlite3 connections kept for reuse by SQLiteAppBase, keyed by
+# process id, thread id, database filename, and pragmas.  This is not
+# stored on the class, so run_batch() does not reset it between items.
+_sqlite_connections = {}
+
+
+class SQLiteAppBase(CommandLineApp):
+    """Base class for applications using a sqlite3 database.
+
+    main() opens the database and calls take_action().  Changes are
+    committed if take_action() returns, and rolled back if it raises
+    an exception.  Connections are kept open and used again by later
+    runs in the same process and thread, so applications run through
+    run_batch() or serve() do not open the database for every command.
+    """
+
+    # PRAGMA settings applied when a connection is opened, as (name,
+    # value) pairs.  For example, (('journal_mode', 'WAL'),
+    # ('synchronous', 'NORMAL'), ('cache_size', -64000)).
+    PRAGMAS = ()
+
+    # Number of rows passed to each executemany() call by insert_many()
+    INSERT_BATCH_SIZE = 10000
+
+    # Number of rows retrieved by each fetchmany() call by iter_rows()
+    FETCH_BATCH_SIZE = 1000
+
+    # Should connections be kept open for later runs?
+    reuse_connections = True
+
+    db_connection = None
+    cursor = None
+
+    dbname = 'sqlite.db'
+    def option_handler_db(self, name):
+        """Specify the database filename.
+        Defaults to 'sqlite.db'.
+        """
+        self.dbname = name
+        return
+
+    _extra_pragmas = ()
+    def option_handler_pragma(self, *setting):
+        """Set a PRAGMA, given as name=value, when the database is
+        opened.
+        """
+        pragmas = list(self._extra_pragmas)
+        for s in setting:
+            name, sep, value = s.partition('=')
+            if not sep:
+                raise ValueError('Invalid pragma %r, expected name=value' % s)
+            pragmas.append((name.strip(), value.strip()))
+        self._extra_pragmas = tuple(pragmas)
+        return
+
+    def get_pragmas(self):
+        "Return the (name, value) PRAGMA settings for the database."
+        return tuple(self.PRAGMAS) + self._extra_pragmas
+
+    def get_connection(self):
+        """Return a connection to the database, opening it and applying
+        the PRAGMA settings if there is no open connection to reuse.
+        """
+        import sqlite3
+        pragmas = self.get_pragmas()
+        key = (os.getpid(), threading.current_thread().ident,
+               os.path.abspath(self.dbname), pragmas)
+        if self.reuse_connections and key in _sqlite_connections:
+            return _sqlite_connections[key]
+        connection = sqlite3.connect(self.dbname)
+        for name, value in pragmas:
+            connection.execute('PRAGMA %s = %s' % (name, value))
+        if self.reuse_connections:
+            _sqlite_connections[key] = connection
+        return connection
+
+    @classmethod
+    def close_connections(cls):
+        "Close the connections kept open for reuse by this process."
+        for key, connection in _sqlite_connections.items():
+            if key[0] == os.getpid():
+                connection.close()
+                del _sqlite_connections[key]
+        return
+
+    def main(self):
+        # Subclasses can override this to control the arguments
+        # used by the program.
+        self.db_connection = self.get_connection()
+        try:
+            self.cursor = self.db_connection.cursor()
+            try:
+                exit_code = self.take_action()
+            except:
+                # throw away changes
+                self.db_connection.rollback()
+                raise
+            else:
+                # save changes
+                self.db_connection.commit()
+        finally:
+            self.cursor.close()
+            if not self.reuse_connections:
+                self.db_connection.close()
+        return exit_code
+
+    def take_action(self):
+        """Override this in the actual application.
+        Return the exit code for the application
+        if no exception is raised.
+        """
+        raise NotImplementedError('Not implemented!')
+
+    def _get_text_index_name(self, table, column):
+        "Return the name of the full text index for table.column."
+        return '%s_%s_fts' % (table, column)
+
+    def create_text_index(self, table, column):
+        """Create a full text index of table.column, to make substring
+        searches with get_substring_filter() faster.
+
+        The index is an FTS5 table using the trigram tokenizer, filled
+        from the rows already in the table and kept up to date by
+        triggers as rows are inserted, updated, and deleted.  Requires
+        a version of SQLite with FTS5.
+        """
+        index = self._get_text_index_name(table, column)
+        names = {'index': index, 'table': table, 'column': column}
+        for statement in [
+            """CREATE VIRTUAL TABLE %(index)s USING fts5(
+                   %(column)s, content=%(table)s, tokenize=trigram)""",
+            """CREATE TRIGGER %(index)s_insert AFTER INSERT ON %(table)s
+               BEGIN
+                   INSERT INTO %(index)s (rowid, %(column)s)
+                   VALUES (new.rowid, new.%(column)s);
+               END""",
+            """CREATE TRIGGER %(index)s_delete AFTER DELETE ON %(table)s
+               BEGIN
+                   INSERT INTO %(index)s (%(index)s, rowid, %(column)s)
+                   VALUES ('delete', old.rowid, old.%(column)s);
+               END""",
+            """CREATE TRIGGER %(index)s_update
+               AFTER UPDATE OF %(column)s ON %(table)s
+               BEGIN
+                   INSERT INTO %(index)s (%(index)s, rowid, %(column)s)
+                   VALUES ('delete', old.rowid, old.%(column)s);
+                   INSERT INTO %(index)s (rowid, %(column)s)
+                   VALUES (new.rowid, new.%(column)s);
+               END""",
+            "INSERT INTO %(index)s (%(index)s) VALUES ('rebuild')",
+            ]:
+            self.cursor.execute(statement % names)
+        return
+
+    def has_text_index(self, table, column):
+        "Does table.column have an index made by create_text_index()?"
+        row = self.db_connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (self._get_text_index_name(table, column),)).fetchone()
+        return row is not None
+
+    def get_substring_filter(self, table, column, substring):
+        """Return a WHERE clause and its parameters to find the rows of
+        table where column contains substring, ignoring case.
+
+        The full text index of the column is used if there is one, and
+        the substring is long enough to search for with it (3
+        characters).  Otherwise the clause uses LIKE, which scans the
+        whole table.
+        """
+        if len(substring) >= 3 and self.has_text_index(table, column):
+            index = self._get_text_index_name(table, column)
+            return ('rowid IN (SELECT rowid FROM %s WHERE %s MATCH ?)'
+                    % (index, index),
+                    ('"%s"' % substring.replace('"', '""'),))
+        pattern = '%%%s%%' % substring.replace(
+            '\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return ("%s LIKE ? ESCAPE '\\'" % column, (pattern,))
+
+    def insert_many(self, sql, rows, batch_size=None):
+        """Run the INSERT statement sql for each of the parameter tuples
+        from the iterable rows, passing them to executemany() in batches
+        of batch_size (INSERT_BATCH_SIZE by default).  Returns the
+        number of rows.
+        """
+        import itertools
+        batch_size = batch_size or self.INSERT_BATCH_SIZE
+        rows = iter(rows)
+        count = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            self.cursor.executemany(sql, batch)
+            count += len(batch)
+        return count
+
+    def iter_rows(self, sql, parameters=(), batch_size=None):
+        """Generate the rows returned by the query sql, retrieving
+        batch_size (FETCH_BATCH_SIZE by default) at a time.
+        """
+        batch_size = batch_size or self.FETCH_BATCH_SIZE
+        cursor = self.db_connection.cursor()
+        try:
+            cursor.execute(sql, parameters)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+        return
+
+    def write_rows(self, sql, parameters=(), row_format=None):
+        """Write the rows returned by the query sql to the output
+        stream, formatted with row_format or separated by tabs.  The
+        rows are retrieved and written FETCH_BATCH_SIZE at a time.
+        Returns the number of rows.
+        """
+        output = self.get_output()
+        cursor = self.db_connection.cursor()
+        count = 0
+        try:
+            cursor.execute(sql, parameters)
+            while True:
+                rows = cursor.fetchmany(self.FETCH_BATCH_SIZE)
+                if not rows:
+                    break
+                if row_format is None:
+                    lines = [ u'\t'.join(map(unicode, row)) for row in rows ]
+                else:
+                    lines = [ row_format % tuple(row) for row in rows ]
+                lines.append('')
+                text = u'\n'.join(lines)
+                if isinstance(text, unicode):
+                    text = text.encode('utf-8')
+                output.write(text)
+                count += len(rows)
+        finally:
+            cursor.close()
+        return count
+
+
+def fork_launcher(app_class, command_lines, jobs=1):
+    """Run many command lines, each in a process forked from a
+    prepared parent.
+
+    The app_class is a CommandLineApp subclass or the name of one
+    (see _import_class()).  It is imported and prepared with
+    prepare_class() once, then a child process is forked to run each
+    command line so the imported modules, option table, and class
+    level setup are shared with the children.  Each command line is
+    either a string, which is split like a shell would, or a sequence
+    of arguments.  Up to jobs children run at the same time, all
+    writing to the standard streams of the launcher.
+
+    Generates a tuple containing the arguments and exit code for each
+    command line as its child finishes.
+    """
+    if isinstance(app_class, basestring):
+        app_class = _import_class(app_class)
+    app_class.prepare_class()
+
+    running = {}
+
+    def wait_for_child():
+        pid, status = os.wait()
+        if os.WIFSIGNALED(status):
+            exit_code = 128 + os.WTERMSIG(status)
+        else:
+            exit_code = os.WEXITSTATUS(status)
+        return (running.pop(pid), exit_code)
+
+    for command_line in command_lines:
+        command_line = _split_command_line(command_line)
+        while len(running) >= jobs:
+            yield wait_for_child()
+        # Do not let the child inherit buffered output.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if not pid:
+            exit_code = 1
+            try:
+                exit_code = _exit_status(app_class._run_with_streams(
+                    command_line, sys.stdin, sys.stdout, sys.stderr))
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(exit_code)
+        running[pid] = command_line
+
+    while running:
+        yield wait_for_child()
+    return
+
+
+def call_server(socket_path, command_line_options=None,
+                stdin=None, stdout=None, stderr=None):
+    """Run a command line in an application started with
+    CommandLineApp.serve() and return its exit code.
+
+    The arguments default to ``sys.argv[1:]`` and the standard streams
+    of the current process.  The current environment and working
+    directory are sent along with the arguments.
+    """
+    import socket
+    if command_line_options is None:
+        command_line_options = sys.argv[1:]
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        connection = _FrameConnection(sock)
+        # Arguments and environment variables are bytes, which may not
+        # be in any particular encoding.
+        connection.write_frame('A', marshal.dumps({
+            'argv': list(command_line_options),
+            'env': dict(os.environ),
+            'cwd': os.getcwd(),
+        }))
+
+        def send_input():
+            # Forward standard input until it is exhausted or the
+            # server closes the connection.
+            try:
+                while True:
+                    try:
+                        data = os.read(stdin.fileno(), 64 * 1024)
+                    except (AttributeError, ValueError):
+                        data = stdin.read(64 * 1024)
+                    connection.write_frame('I', data)
+                    if not data:
+                        break
+            except (IOError, OSError, socket.error):
+                pass
+        input_thread = threading.Thread(target=send_input)
+        input_thread.setDaemon(True)
+        input_thread.start()
+
+        exit_code = 1
+        while True:
+            kind, data = connection.read_frame()
+            if kind == 'O':
+                stdout.write(data)
+            elif kind == 'E':
+                stderr.write(data)
+            elif kind == 'X':
+                exit_code = int(data)
+                break
+            else:
+                stderr.write('ERROR: Lost connection to %s\n' % socket_path)
+                break
+    finally:
+        sock.close()
+    stdout.flush()
+    return exit_code
+
+
+def write_help_files(app_classes, format='man', directory='.'):
+    """Write the help for each of the application classes to a file
+    in directory, named for the program with an extension for the
+    format ('man', 'markdown', or 'html').
+
+    The classes can be given as 'module:Class' strings.  They are only
+    imported, so many programs can be documented in one process without
+    running them.  Returns the names of the files written.
+    """
+    try:
+        extension = _HELP_RENDERERS[format][1]
+    except KeyError:
+        raise ValueError('Unsupported help format "%s"' % format)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filenames = []
+    for app_class in app_classes:
+        if isinstance(app_class, basestring):
+            app_class = _import_class(app_class)
+        filename = os.path.join(directory,
+                                app_class._get_help_name() + extension)
+        f = open(filename, 'w')
+        try:
+            f.write(app_class.render_help(format))
+        finally:
+            f.close()
+        filenames.append(filename)
+    return filenames
 
 if __name__ == '__main__':
     CommandLineApp().run()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Concatenate csv files.
+
+This is the csvcat program from the Python Magazine article, grown
+into a tool for large files.  Files can be read in parallel, selected
+columns are picked out as each row is parsed, and files that do not
+need to change are copied without being parsed at all.
+"""
+
+import csv
+import itertools
+import operator
+import os
+import shutil
+import tempfile
+
+import commandlineapp
+
+# The app being run by the worker processes, like
+# commandlineapp._fan_out_app.
+_worker_app = None
+
+
+def _write_temp_file(args):
+    "Worker function to convert one input file to a temporary file."
+    filename, include_header, temp_filename = args
+    output = open(temp_filename, 'wb', _worker_app.COPY_BUFFER_SIZE)
+    try:
+        _worker_app.write_file(filename, output, include_header)
+    finally:
+        output.close()
+    return temp_filename
+
+
+class csvcat(commandlineapp.CommandLineApp):
+    """Concatenate comma separated value files.
+
+    When all of the columns are included and the dialect is "excel",
+    the files are copied without being parsed, so their rows keep the
+    line endings they had in the input.  Otherwise every row ends with
+    the line terminator of the output dialect.
+    """
+
+    _app_name = 'csvcat'
+
+    EXAMPLES_DESCRIPTION = '''
+To concatenate 2 files, including all columns and headers:
+
+  $ csvcat file1.csv file2.csv
+
+To concatenate 2 files, skipping the headers in the second file:
+
+  $ csvcat --skip-headers file1.csv file2.csv
+
+To concatenate 2 files, including only the first and third columns:
+
+  $ csvcat --col 0,2 file1.csv file2.csv
+
+To read 4 files at a time and write a compressed result:
+
+  $ csvcat --jobs 4 --output all.csv.gz *.csv
+'''
+
+    # Number of bytes copied at a time by the unparsed copy
+    COPY_BUFFER_SIZE = 1024 * 1024
+
+    def show_verbose_help(self):
+        commandlineapp.CommandLineApp.show_verbose_help(self)
+        print
+        print 'OUTPUT DIALECTS:'
+        print
+        for name in csv.list_dialects():
+            print '\t%s' % name
+        print
+        return
+
+    skip_headers = False
+    def option_handler_skip_headers(self):
+        """Treat the first line of each file as a header,
+        and only include one copy in the output.
+        """
+        self.skip_headers = True
+        return
+
+    dialect = "excel"
+    def option_handler_dialect(self, name):
+        """Specify the output dialect name.
+        Defaults to "excel".
+        """
+        self.dialect = name
+        return
+    option_handler_d = option_handler_dialect
+
+    columns = ()
+    def option_handler_columns(self, *col):
+        """Limit the output to the specified columns.
+        Columns are identified by number, starting with 0.
+        """
+        self.columns = self.columns + tuple([int(c) for c in col])
+        return
+    option_handler_c = option_handler_columns
+
+    jobs = 1
+    def option_handler_jobs(self, num):
+        """Parse up to num files in parallel.
+        """
+        self.jobs = int(num)
+        return
+
+    def get_row_filter(self):
+        """Return a function to pick the selected columns out of a
+        row, or None if all columns are included.
+        """
+        if not self.columns:
+            return None
+        if len(self.columns) == 1:
+            column = self.columns[0]
+            return lambda row: (row[column],)
+        return operator.itemgetter(*self.columns)
+
+    def copy_file(self, f, output):
+        """Copy the rows of an open input file to output without
+        parsing them, ending the last row if the file does not.
+        """
+        last = ''
+        while True:
+            data = f.read(self.COPY_BUFFER_SIZE)
+            if not data:
+                break
+            output.write(data)
+            last = data
+        if last and not last.endswith('\n'):
+            # Use the line ending of the other rows, so the next file
+            # starts on its own line.
+            if '\n' in last and '\r\n' not in last:
+                output.write('\n')
+            else:
+                output.write('\r\n')
+        return
+
+    def write_file(self, filename, output, include_header=True):
+        """Write the rows of one input file to output.
+
+        When all of the columns are included and the output dialect
+        matches the input, the file is copied without being parsed.
+        """
+        f = self.open_input(filename)
+        try:
+            if not include_header:
+                # Headers do not span lines, so there is no need to
+                # parse the row to skip it.
+                f.readline()
+            row_filter = self.get_row_filter()
+            if row_filter is None and self.dialect == 'excel':
+                self.copy_file(f, output)
+                return
+            rows = csv.reader(f)
+            if row_filter is not None:
+                rows = itertools.imap(row_filter, rows)
+            csv.writer(output, dialect=self.dialect).writerows(rows)
+        finally:
+            f.close()
+        return
+
+    def _include_header(self, position):
+        "Should the header of the file at position be written?"
+        return position == 0 or not self.skip_headers
+
+    def _write_files_in_parallel(self, filenames, output):
+        """Convert the files in worker processes, and copy the results
+        to output in the order the files were named.
+        """
+        global _worker_app
+        from multiprocessing import Pool
+
+        tempdir = tempfile.mkdtemp(prefix='csvcat-')
+        tasks = [ (name, self._include_header(i), os.path.join(tempdir, str(i)))
+                  for i, name in enumerate(filenames) ]
+        _worker_app = self
+        pool = Pool(self.jobs)
+        try:
+            results = pool.imap(_write_temp_file, tasks)
+            while True:
+                try:
+                    temp_filename = results.next(
+                        commandlineapp._POOL_WAIT_TIMEOUT)
+                except StopIteration:
+                    break
+                f = open(temp_filename, 'rb')
+                try:
+                    shutil.copyfileobj(f, output, self.COPY_BUFFER_SIZE)
+                finally:
+                    f.close()
+                os.unlink(temp_filename)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_app = None
+            shutil.rmtree(tempdir)
+        return
+
+    def main(self, *filename):
+        """
+        The names of comma separated value files, such as might be
+        exported from a spreadsheet or database program.  Use - to
+        read from standard input.
+        """
+        output = self.get_output()
+        # Copying files is limited by I/O, so only parse them in
+        # parallel.  Worker processes cannot read our standard input.
+        parsing = self.get_row_filter() is not None or self.dialect != 'excel'
+        if parsing and self.jobs > 1 and len(filename) > 1 \
+                and '-' not in filename:
+            self._write_files_in_parallel(filename, output)
+        else:
+            for i, name in enumerate(filename):
+                self.write_file(name, output, self._include_header(i))
+        return
+
+if __name__ == '__main__':
+    csvcat().run()
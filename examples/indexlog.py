@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+"""Add the message index used by showlog --message to a log database
+created before initdb made it.
+"""
+
+import commandlineapp
+
+
+class indexlog(commandlineapp.SQLiteAppBase):
+    """Index the messages in the log.
+    """
+
+    _app_name = 'indexlog'
+
+    def take_action(self):
+        if self.has_text_index('log', 'message'):
+            self.status_message('%s is already indexed' % self.dbname)
+            return 0
+        self.status_message('Indexing messages in %s' % self.dbname)
+        self.create_text_index('log', 'message')
+        return 0
+
+if __name__ == '__main__':
+    indexlog().run()
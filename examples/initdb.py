@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""Initialize the log database used by showlog.
+"""
+
+import sqlite3
+import time
+
+import commandlineapp
+
+
+class initdb(commandlineapp.SQLiteAppBase):
+    """Initialize a database.
+    """
+
+    _app_name = 'initdb'
+
+    PRAGMAS = (('journal_mode', 'WAL'),
+               ('synchronous', 'NORMAL'),
+               )
+
+    def take_action(self):
+        self.status_message('Initializing database %s' % self.dbname)
+        # Create the table
+        self.cursor.execute("CREATE TABLE log (date text, message text)")
+        # Index the messages for showlog --message
+        try:
+            self.create_text_index('log', 'message')
+        except sqlite3.OperationalError, err:
+            self.status_message('Not indexing messages: %s' % err)
+        # Log the actions taken
+        self.insert_many(
+            "INSERT INTO log (date, message) VALUES (?, ?)",
+            [(time.ctime(), 'Created database'),
+             (time.ctime(), 'Created log table'),
+             ])
+        return 0
+
+if __name__ == '__main__':
+    initdb().run()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+"""Show the contents of the log database created by initdb.
+"""
+
+import commandlineapp
+
+
+class showlog(commandlineapp.SQLiteAppBase):
+    """Show the contents of the log.
+    """
+
+    _app_name = 'showlog'
+
+    PRAGMAS = (('journal_mode', 'WAL'),
+               ('synchronous', 'NORMAL'),
+               )
+
+    substring = None
+    def option_handler_message(self, substring):
+        """Look for messages with the substring.
+        """
+        self.substring = substring
+        return
+
+    def take_action(self):
+        if self.substring:
+            # Uses the index created by initdb or indexlog, if there is
+            # one, instead of scanning the table.
+            where, parameters = self.get_substring_filter(
+                'log', 'message', self.substring)
+            self.write_rows("SELECT * FROM log WHERE %s ORDER BY rowid" % where,
+                            parameters, '%-30s %s')
+        else:
+            self.write_rows("SELECT * FROM log", (), '%-30s %s')
+        return 0
+
+if __name__ == '__main__':
+    showlog().run()
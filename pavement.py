@@ -89,6 +89,19 @@ options(
     minilib = Bunch(
         extra_files=['doctools'],
     ),
+
+    # Application classes to document with the helpdocs task, as
+    # module:Class names.
+    helpdocs = Bunch(
+        classes=['csvcat:csvcat',
+                 'initdb:initdb',
+                 'indexlog:indexlog',
+                 'showlog:showlog',
+                 ],
+        path=['examples'],
+        formats=['man', 'markdown', 'html'],
+        outdir='docs/build/help',
+    ),
     
 )
 
@@ -190,6 +203,35 @@ def html(options):
     paver.doctools.html(options)
     return
 
+@task
+@cmdopts([
+    ('classes=', 'c', 'Comma separated module:Class names to document'),
+    ('formats=', 'f', 'Comma separated formats (man, markdown, html)'),
+    ('outdir=', 'o', 'Directory for the help files'),
+])
+def helpdocs(options):
+    """Write man pages, Markdown, and HTML help for application classes.
+
+    The classes are only imported, not run, so all of them are
+    documented in one process.
+    """
+    import sys
+    sys.path[0:0] = [os.getcwd()] + list(options.helpdocs.path)
+    import commandlineapp
+
+    def as_list(value):
+        if isinstance(value, basestring):
+            return [ v.strip() for v in value.split(',') if v.strip() ]
+        return value
+
+    classes = as_list(options.helpdocs.classes)
+    for format in as_list(options.helpdocs.formats):
+        outdir = os.path.join(options.helpdocs.outdir, format)
+        for filename in commandlineapp.write_help_files(classes, format,
+                                                        outdir):
+            print filename
+    return
+
 @task
 def installwebsite(options):
     html(options)
@@ -34,11 +34,20 @@ __module_id__ = "$Id$"
 # Import system modules
 #
 from StringIO import StringIO
+import getopt
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 #
 # Import local modules
 #
+import commandlineapp
 from commandlineapp import CommandLineApp
 
 #
@@ -100,7 +109,10 @@ class CLATestCase(unittest.TestCase):
              ('--kwd', 'kwd', 'default', 'value', False),
              ('--multi-args', 'multi_args', 'options', None, True),
              ('-n', 'n', None, None, False),
+             ('--output', 'output', 'filename', None, False),
              ('--quiet', 'quiet', None, None, False),
+             ('--stats', 'stats', None, None, False),
+             ('--stats-json', 'stats_json', None, None, False),
              ('-v', 'v', None, None, False),
              ('--verbose', 'verbose', 'level', 1, False),
              ])
@@ -280,6 +292,1474 @@ class CLATestCase(unittest.TestCase):
         self.failUnlessEqual(exit_code, 99)
         return
 
+    def test_no_event_loop_for_plain_main(self):
+        class CLAPlainMainTest(CommandLineApp):
+            force_exit = False
+            def main(self, *args):
+                return 3
+
+        app = CLAPlainMainTest([])
+        self.failUnlessEqual(app.run(), 3)
+        self.failUnless(app._event_loop is None)
+        return
+
+    @unittest.skipIf(commandlineapp.asyncio is None
+                     or not hasattr(commandlineapp.asyncio, 'coroutine'),
+                     'no asyncio support')
+    def test_coroutine_main(self):
+        asyncio = commandlineapp.asyncio
+        class CLACoroutineMainTest(CommandLineApp):
+            force_exit = False
+            ran_option = False
+            ran_main = False
+            @asyncio.coroutine
+            def option_handler_t(self):
+                self.ran_option = True
+            @asyncio.coroutine
+            def main(self, *args):
+                self.ran_main = True
+
+        app = CLACoroutineMainTest(['-t'])
+        app.run()
+        self.failUnless(app.ran_option)
+        self.failUnless(app.ran_main)
+        self.failUnless(app._event_loop is None)
+        return
+
+    def test_coroutine_stub_loop(self):
+        # A minimal event loop, so the coroutine support is tested
+        # without asyncio.  The coroutines are generators, and the last
+        # value they produce is their result.
+        events = []
+        class StubCancelledError(Exception):
+            pass
+        class StubTask(object):
+            def __init__(self, coro):
+                self.coro = coro
+                self.cancelled = False
+            def cancel(self):
+                self.cancelled = True
+        class StubLoop(object):
+            def create_task(self, coro):
+                return StubTask(coro)
+            def run_until_complete(self, task):
+                result = None
+                try:
+                    if task.cancelled:
+                        task.coro.throw(StubCancelledError())
+                    while True:
+                        result = task.coro.next()
+                        if result is KeyboardInterrupt:
+                            raise KeyboardInterrupt()
+                except StopIteration:
+                    return result
+            def close(self):
+                events.append('close')
+        class StubAsyncio(object):
+            CancelledError = StubCancelledError
+            new_event_loop = StubLoop
+            @staticmethod
+            def iscoroutinefunction(func):
+                return getattr(func, 'is_coroutine', False)
+        def coroutine(func):
+            func.is_coroutine = True
+            return func
+
+        original_asyncio = commandlineapp.asyncio
+        commandlineapp.asyncio = StubAsyncio
+        try:
+            class CLACoroutineStubTest(CommandLineApp):
+                force_exit = False
+                @coroutine
+                def option_handler_t(self):
+                    events.append('option')
+                    yield
+                @coroutine
+                def main(self, arg):
+                    events.append('main')
+                    yield 'step'
+                    yield int(arg)
+            self.failUnlessEqual(CLACoroutineStubTest(['-t', '4']).run(), 4)
+            self.failUnlessEqual(events, ['option', 'main', 'close'])
+
+            # Interrupted coroutines are cancelled before the
+            # interrupt is handled.
+            del events[:]
+            class CLACoroutineInterruptTest(CommandLineApp):
+                force_exit = False
+                def handle_interrupt(self):
+                    events.append('interrupt')
+                    return 9
+                @coroutine
+                def main(self):
+                    try:
+                        yield KeyboardInterrupt
+                    finally:
+                        events.append('cleanup')
+            self.failUnlessEqual(CLACoroutineInterruptTest([]).run(), 9)
+            self.failUnlessEqual(events, ['cleanup', 'interrupt', 'close'])
+
+            del events[:]
+            class CLACoroutineItemTest(CommandLineApp):
+                force_exit = False
+                @coroutine
+                def main_item(self, arg):
+                    events.append(arg)
+                    if arg == 'bad':
+                        raise SystemExit(7)
+                    yield len(arg)
+            app = CLACoroutineItemTest(['a', 'bb', 'ccc'])
+            self.failIf('--jobs' in [ o.switch for o in app.supported_options ])
+            self.failUnlessEqual(app.run(), 3)
+            self.failUnlessEqual(CLACoroutineItemTest(['bad', 'a']).run(), 7)
+            self.failUnlessEqual(events,
+                                 ['a', 'bb', 'ccc', 'close', 'bad', 'a', 'close'])
+        finally:
+            commandlineapp.asyncio = original_asyncio
+        return
+
+    def test_main_item_serial(self):
+        class CLAMainItemTest(CommandLineApp):
+            force_exit = False
+            def __init__(self, *args):
+                self.items = []
+                self.errors = []
+                CommandLineApp.__init__(self, *args)
+            def handle_main_exception(self, err):
+                self.errors.append(str(err))
+                return 5
+            def main_item(self, arg):
+                if arg == 'bad':
+                    raise RuntimeError(arg)
+                self.items.append(arg)
+                return 0
+
+        app = CLAMainItemTest(['a', 'bad', 'b'])
+        exit_code = app.run()
+        self.failUnlessEqual(app.items, ['a', 'b'])
+        self.failUnlessEqual(app.errors, ['bad'])
+        self.failUnlessEqual(exit_code, 5)
+        return
+
+    def test_jobs_option_requires_main_item(self):
+        class CLANoMainItemTest(CommandLineApp):
+            pass
+        class CLAWithMainItemTest(CommandLineApp):
+            def main_item(self, arg):
+                return 0
+
+        switches = [ o.switch for o in CLANoMainItemTest([]).supported_options ]
+        self.failIf('--jobs' in switches)
+        switches = [ o.switch for o in CLAWithMainItemTest([]).supported_options ]
+        self.failUnless('--jobs' in switches)
+        class CLAOwnJobsTest(CommandLineApp):
+            def option_handler_jobs(self, num):
+                return
+        switches = [ o.switch for o in CLAOwnJobsTest([]).supported_options ]
+        self.failUnless('--jobs' in switches)
+        return
+
+    def _run_main_item_jobs(self, fan_out_processes):
+        class CLAMainItemJobsTest(CommandLineApp):
+            force_exit = False
+            def main_item(self, arg):
+                # Finish the items in reverse order to show that the
+                # output is still written in argument order.
+                time.sleep(0.01 * (5 - int(arg)))
+                print 'item', arg
+                return int(arg)
+        CLAMainItemJobsTest.fan_out_processes = fan_out_processes
+
+        app = CLAMainItemJobsTest(['--jobs=4', '1', '2', '3', '4'])
+        stdout = sys.stdout
+        sys.stdout = buffer = StringIO()
+        try:
+            exit_code = app.run()
+        finally:
+            sys.stdout = stdout
+        self.failUnlessEqual(exit_code, 4)
+        self.failUnlessEqual(buffer.getvalue(),
+                             'item 1\nitem 2\nitem 3\nitem 4\n')
+        return
+
+    def test_main_item_thread_jobs(self):
+        self._run_main_item_jobs(False)
+        return
+
+    def test_main_item_process_jobs(self):
+        self._run_main_item_jobs(True)
+        return
+
+    def test_server(self):
+        class CLAServerTest(CommandLineApp):
+            names = []
+            def option_handler_fail(self):
+                sys.exit(3)
+            def option_handler_name(self, name):
+                self.names.append(name)
+                print self.names
+            def main(self, *args):
+                print ' '.join(args), os.environ.get('CLA_SERVER_TEST')
+                sys.stderr.write(sys.stdin.read())
+                return len(args)
+
+        socket_path = tempfile.mktemp()
+        pid = os.fork()
+        if not pid:
+            try:
+                CLAServerTest.serve(socket_path)
+            finally:
+                os._exit(0)
+        try:
+            for i in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.01)
+            os.environ['CLA_SERVER_TEST'] = 'env'
+            for args in [ ('a', 'b'), ('caf\xe9',) ]:
+                stdout = StringIO()
+                stderr = StringIO()
+                exit_code = commandlineapp.call_server(
+                    socket_path, args,
+                    stdin=StringIO('input'), stdout=stdout, stderr=stderr)
+                self.failUnlessEqual(exit_code, len(args))
+                self.failUnlessEqual(stdout.getvalue(),
+                                     '%s env\n' % ' '.join(args))
+                self.failUnlessEqual(stderr.getvalue(), 'input')
+            # Exiting from a request does not stop the server
+            exit_code = commandlineapp.call_server(
+                socket_path, ['--fail'], stdin=StringIO(''))
+            self.failUnlessEqual(exit_code, 3)
+            exit_code = commandlineapp.call_server(
+                socket_path, [], stdin=StringIO(''), stdout=StringIO())
+            self.failUnlessEqual(exit_code, 0)
+            # Class attributes changed by one request are reset.
+            for name in ('a', 'b'):
+                stdout = StringIO()
+                commandlineapp.call_server(
+                    socket_path, ['--name', name], stdin=StringIO(''),
+                    stdout=stdout)
+                self.failUnlessEqual(stdout.getvalue().splitlines()[0],
+                                     repr([name]))
+        finally:
+            del os.environ['CLA_SERVER_TEST']
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+        return
+
+    def test_prepare_class(self):
+        class CLAPrepareClassTest(CommandLineApp):
+            setup_count = 0
+            @classmethod
+            def class_setup_hook(cls):
+                cls.setup_count += 1
+
+        CLAPrepareClassTest.prepare_class()
+        CLAPrepareClassTest([])
+        CLAPrepareClassTest([])
+        self.failUnlessEqual(CLAPrepareClassTest.setup_count, 1)
+        self.failUnless('_option_table' in CLAPrepareClassTest.__dict__)
+        return
+
+    def test_fork_launcher(self):
+        class CLAForkLauncherTest(CommandLineApp):
+            pids = []
+            @classmethod
+            def class_setup_hook(cls):
+                cls.pids.append(os.getpid())
+            def main(self, *args):
+                assert self.pids != [os.getpid()]
+                return len(args)
+
+        results = list(commandlineapp.fork_launcher(
+            CLAForkLauncherTest, ['a b', ['c'], 'd "e f" g']))
+        self.failUnlessEqual(results, [ (['a', 'b'], 2),
+                                        (['c'], 1),
+                                        (['d', 'e f', 'g'], 3),
+                                        ])
+        self.failUnlessEqual(CLAForkLauncherTest.pids, [os.getpid()])
+        return
+
+    def _check_run_batch(self, jobs):
+        class CLARunBatchTest(CommandLineApp):
+            names = []
+            def option_handler_name(self, name):
+                self.names.append(name)
+            def main(self, *args):
+                if args == ('fail',):
+                    raise RuntimeError('failed')
+                print ' '.join(self.names + list(args)), self.verbose_level
+                return len(args)
+
+        hook_tables = []
+        def record_hook_table(app, exit_code):
+            hook_tables.append(CLARunBatchTest.__dict__['_hook_table'])
+        CLARunBatchTest.add_hook('exit', record_hook_table)
+
+        results = list(CLARunBatchTest.run_batch(
+            [ '--name=a -v x', ['y', 'z'], '--name b', 'fail' ],
+            jobs=jobs))
+        if jobs == 1:
+            # The hook table is only built once.
+            self.failUnlessEqual(len(hook_tables), 4)
+            for table in hook_tables:
+                self.failUnless(table is hook_tables[0])
+        self.failUnlessEqual([ r.command_line_options for r in results ],
+                             [ ['--name=a', '-v', 'x'],
+                               ['y', 'z'],
+                               ['--name', 'b'],
+                               ['fail'],
+                               ])
+        self.failUnlessEqual([ r.exit_code for r in results ], [1, 2, 0, 1])
+        self.failUnlessEqual([ r.output for r in results ],
+                             [ 'a x 2\n', 'y z 1\n', 'b 1\n', '' ])
+        self.failUnlessEqual(results[-1].error_output, 'ERROR: failed\n\n')
+        self.failUnlessEqual(CLARunBatchTest.names, [])
+        return
+
+    def test_run_batch(self):
+        self._check_run_batch(1)
+        return
+
+    def test_run_batch_jobs(self):
+        self._check_run_batch(2)
+        return
+
+    def test_subcommands(self):
+        module_dir = tempfile.mkdtemp()
+        module_file = open(os.path.join(module_dir, 'cla_lazy_subcommand.py'), 'w')
+        module_file.write('''
+from commandlineapp import CommandLineApp
+class Lazy(CommandLineApp):
+    "Imported only when used."
+    def main(self, arg):
+        return int(arg) + self.verbose_level
+''')
+        module_file.close()
+        sys.path.insert(0, module_dir)
+
+        class CLASubcommandEcho(CommandLineApp):
+            "Echo the arguments."
+            def main(self, *args):
+                assert self.parent_app.global_set
+                return len(args)
+
+        class CLASubcommandTest(CommandLineApp):
+            force_exit = False
+            global_set = False
+            SUBCOMMANDS = { 'echo': CLASubcommandEcho,
+                            'lazy': 'cla_lazy_subcommand:Lazy',
+                            }
+            def option_handler_g(self):
+                self.global_set = True
+            def show_help(self, error_message=None):
+                self.help_message = error_message
+
+        try:
+            app = CLASubcommandTest(['-g', 'echo', 'a', 'b'])
+            self.failUnlessEqual(app.run(), 2)
+            self.failIf('cla_lazy_subcommand' in sys.modules)
+
+            app = CLASubcommandTest(['-v', 'lazy', '3'])
+            self.failUnlessEqual(app.run(), 5)
+            self.failUnless('cla_lazy_subcommand' in sys.modules)
+
+            app = CLASubcommandTest(['missing'])
+            self.failUnlessEqual(app.run(), 1)
+            self.failUnlessEqual(app.help_message, 'Unknown command "missing".')
+
+            help_text = app.get_verbose_syntax_help_string()
+            self.failUnless('''COMMANDS:
+
+    echo
+        Echo the arguments.
+
+    lazy
+        Imported only when used.
+''' in help_text)
+        finally:
+            sys.path.remove(module_dir)
+            sys.modules.pop('cla_lazy_subcommand', None)
+            shutil.rmtree(module_dir)
+        return
+
+    def test_completions(self):
+        class CLACompletionSub(CommandLineApp):
+            def option_handler_sub_option(self):
+                "Only for the subcommand."
+
+        class CLACompletionTest(CommandLineApp):
+            force_exit = False
+            SUBCOMMANDS = { 'sub': CLACompletionSub, 'other': CLACompletionSub }
+            def before_options_hook(self):
+                raise AssertionError('Should not run the hooks')
+            def option_handler_file(self, name):
+                "The file to use."
+            option_handler_f = option_handler_file
+
+        app = CLACompletionTest(['--_complete'])
+        self.failUnlessEqual(app.get_completions(['--f']),
+                             [('--file=', 'The file to use.')])
+        self.failUnlessEqual(app.get_completions(['-f']),
+                             [('-f', 'The file to use.')])
+        self.failUnlessEqual(app.get_completions(['-f', '']), [])
+        self.failUnlessEqual(app.get_completions(['--file', '=', 'x']), [])
+        self.failUnlessEqual(app.get_completions(['']),
+                             [('other', ''), ('sub', '')])
+        self.failUnlessEqual(app.get_completions(['-f', 'x', 's']),
+                             [('sub', '')])
+        self.failUnlessEqual(app.get_completions(['sub', '--su']),
+                             [('--sub-option', 'Only for the subcommand.')])
+
+        stdout = sys.stdout
+        sys.stdout = buffer = StringIO()
+        try:
+            exit_code = CLACompletionTest(['--_complete', '--fi']).run()
+        finally:
+            sys.stdout = stdout
+        self.failUnlessEqual(exit_code, 0)
+        self.failUnlessEqual(buffer.getvalue(), '--file=\tThe file to use.\n')
+        return
+
+    def test_completion_script(self):
+        class CLACompletionScriptTest(CommandLineApp):
+            _app_name = 'cla-test'
+
+        app = CLACompletionScriptTest([])
+        self.failUnless('complete -o default -F _cla_test_complete cla-test'
+                        in app.get_completion_script('bash'))
+        self.failUnless('compdef _cla_test_complete cla-test'
+                        in app.get_completion_script('zsh'))
+        self.failUnless("complete -c cla-test -a '(_cla_test_complete)'"
+                        in app.get_completion_script('fish'))
+        self.failUnlessRaises(ValueError, app.get_completion_script, 'csh')
+        return
+
+    def test_configured_options(self):
+        cache_dir = tempfile.mkdtemp()
+        config_filename = os.path.join(cache_dir, 'cla.ini')
+        config_file = open(config_filename, 'wt')
+        config_file.write('''
+[cla-config]
+name = from-file
+multi = a,b
+flag = yes
+
+[other-app]
+name = not-used
+''')
+        config_file.close()
+
+        class CLAConfigTest(CommandLineApp):
+            force_exit = False
+            _app_name = 'cla-config.py'
+            CONFIG_FILES = [config_filename, '~/cla-missing.ini']
+            ENVIRONMENT_PREFIX = 'CLA_CONFIG'
+            flag = False
+            def __init__(self, *args):
+                self.names = []
+                CommandLineApp.__init__(self, *args)
+            def option_handler_name(self, name):
+                self.names.append(name)
+            def option_handler_multi(self, *values):
+                self.multi = values
+            def option_handler_flag(self):
+                self.flag = True
+
+        original_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = cache_dir
+        os.environ['CLA_CONFIG_NAME'] = 'from-env'
+        try:
+            app = CLAConfigTest(['--name=from-argv'])
+            app.run()
+            self.failUnlessEqual(app.names,
+                                 ['from-file', 'from-env', 'from-argv'])
+            self.failUnlessEqual(app.multi, ('a', 'b'))
+            self.failUnless(app.flag)
+
+            # The parsed file is cached on disk for other processes.
+            commandlineapp._config_cache.clear()
+            cache_files = os.listdir(os.path.join(cache_dir, 'commandlineapp'))
+            self.failUnlessEqual(len(cache_files), 1)
+            self.failUnlessEqual(
+                commandlineapp._load_config_file(config_filename)['cla-config'],
+                {'name': 'from-file', 'multi': 'a,b', 'flag': 'yes'})
+
+            # Unknown options in the app's section are errors.
+            config_file = open(config_filename, 'at')
+            config_file.write('[cla-config]\nunknown = 1\n')
+            config_file.close()
+            app = CLAConfigTest([])
+            app.handle_main_exception = lambda err: str(err)
+            self.failUnlessEqual(app.run(),
+                                 'Unknown option "unknown" in %s' % config_filename)
+        finally:
+            del os.environ['CLA_CONFIG_NAME']
+            if original_cache_home is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = original_cache_home
+            commandlineapp._config_cache.clear()
+            shutil.rmtree(cache_dir)
+        return
+
+    def test_result_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        input_filename = os.path.join(cache_dir, 'input.txt')
+        input_file = open(input_filename, 'wt')
+        input_file.write('one')
+        input_file.close()
+
+        class CLAResultCacheTest(CommandLineApp):
+            force_exit = False
+            cache_results = True
+            RESULT_CACHE_HASH_INPUTS = True
+            calls = 0
+            def option_handler_upper(self):
+                self.upper = True
+            def get_cache_input_files(self, *args):
+                return [input_filename]
+            def main(self, *args):
+                CLAResultCacheTest.calls += 1
+                text = open(input_filename).read() + ' '.join(args)
+                if getattr(self, 'upper', False):
+                    text = text.upper()
+                print text
+                return len(args)
+
+        def run(*args):
+            stdout = sys.stdout
+            sys.stdout = buffer = StringIO()
+            try:
+                exit_code = CLAResultCacheTest(list(args)).run()
+            finally:
+                sys.stdout = stdout
+            return (exit_code, buffer.getvalue())
+
+        original_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = cache_dir
+        try:
+            self.failUnlessEqual(run('a'), (1, 'onea\n'))
+            self.failUnlessEqual(run('a'), (1, 'onea\n'))
+            self.failUnlessEqual(CLAResultCacheTest.calls, 1)
+            self.failUnlessEqual(run('--upper', 'a'), (1, 'ONEA\n'))
+            self.failUnlessEqual(CLAResultCacheTest.calls, 2)
+
+            input_file = open(input_filename, 'wt')
+            input_file.write('two')
+            input_file.close()
+            self.failUnlessEqual(run('a'), (1, 'twoa\n'))
+            self.failUnlessEqual(CLAResultCacheTest.calls, 3)
+
+            results_dir = os.path.join(cache_dir, 'commandlineapp', 'results')
+            self.failUnlessEqual(len(os.listdir(results_dir)), 3)
+            commandlineapp._prune_cache_dir(results_dir, 1)
+            self.failUnlessEqual(len(os.listdir(results_dir)), 0)
+        finally:
+            if original_cache_home is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = original_cache_home
+            shutil.rmtree(cache_dir)
+        return
+
+    def test_resource_usage(self):
+        class CLAResourceUsageTest(CommandLineApp):
+            force_exit = False
+            def main(self, *args):
+                self.status_message('hello')
+                return 2
+
+        app = CLAResourceUsageTest(['--stats', '--quiet'])
+        app.run()
+        self.failUnlessEqual(app.resource_usage['status_bytes'], 0)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            app = CLAResourceUsageTest(['--stats'])
+            app.run()
+        finally:
+            sys.stdout = stdout
+        usage = app.resource_usage
+        self.failUnlessEqual(usage['exit_code'], 2)
+        self.failUnlessEqual(usage['status_bytes'], len('hello\n'))
+        self.failUnless(usage['wall_time'] >= 0)
+        app = CLAResourceUsageTest(['--quiet'])
+        app.run()
+        self.failUnless(app.resource_usage is None)
+        return
+
+    def test_resource_usage_report(self):
+        class CLAResourceUsageReportTest(CommandLineApp):
+            _app_name = 'cla-stats'
+            def main(self, *args):
+                return 0
+
+        stderr = sys.stderr
+        sys.stderr = buffer = StringIO()
+        try:
+            self.failUnlessRaises(SystemExit,
+                                  CLAResourceUsageReportTest(['--stats-json']).run)
+        finally:
+            sys.stderr = stderr
+        import json
+        report = json.loads(buffer.getvalue())
+        self.failUnlessEqual(report['app'], 'cla-stats')
+        self.failUnlessEqual(report['exit_code'], 0)
+        return
+
+    @unittest.skipIf(commandlineapp.tracemalloc is None, 'no tracemalloc')
+    def test_trace_malloc(self):
+        class CLATraceMallocTest(CommandLineApp):
+            force_exit = False
+            def main(self, *args):
+                self.data = [ 'x' * 100 for i in range(1000) ]
+                return 0
+
+        report_dir = tempfile.mkdtemp()
+        report_filename = os.path.join(report_dir, 'report.txt')
+        try:
+            app = CLATraceMallocTest(['--trace-malloc-diff',
+                                      '--trace-malloc-file', report_filename,
+                                      '--trace-malloc=3'])
+            self.failUnlessEqual(app.run(), 0)
+            report = open(report_filename).read()
+            self.failUnless('Top 3 memory allocation sites:' in report)
+            self.failUnless('changes in main():' in report)
+            self.failIf(commandlineapp.tracemalloc.is_tracing())
+        finally:
+            shutil.rmtree(report_dir)
+        return
+
+    def test_trace_malloc_unavailable(self):
+        class CLATraceMallocTest(CommandLineApp):
+            force_exit = False
+        switches = [ o.switch for o in CLATraceMallocTest([]).supported_options ]
+        self.failUnlessEqual('--trace-malloc' in switches,
+                             commandlineapp.tracemalloc is not None)
+        return
+
+    def test_hooks(self):
+        events = []
+        def record(event):
+            def callback(app, *args):
+                events.append((event,) + args)
+            return callback
+
+        class CLAHookBase(CommandLineApp):
+            force_exit = False
+            def option_handler_t(self):
+                pass
+            def main(self, *args):
+                if args == ('fail',):
+                    raise RuntimeError('failed')
+                return 2
+            def handle_main_exception(self, err):
+                return 3
+
+        class CLAHookTest(CLAHookBase):
+            pass
+
+        for event in ['after_option', 'before_main', 'after_main', 'exit']:
+            CLAHookTest.add_hook(event, record(event))
+        base_callback = record('base')
+        CLAHookBase.add_hook('before_main', base_callback)
+        CLAHookTest.add_hook('exception', record('exception'))
+
+        app = CLAHookTest(['-t', 'a'])
+        self.failUnlessEqual(app.run(), 2)
+        option_t = [ o for o in app.supported_options if o.switch == '-t' ][0]
+        self.failUnlessEqual(events, [ ('after_option', option_t, ''),
+                                       ('base', ('a',)),
+                                       ('before_main', ('a',)),
+                                       ('after_main', 2),
+                                       ('exit', 2),
+                                       ])
+
+        del events[:]
+        CLAHookBase.remove_hook('before_main', base_callback)
+        app = CLAHookTest(['fail'])
+        self.failUnlessEqual(app.run(), 3)
+        self.failUnlessEqual([ e[0] for e in events ],
+                             ['before_main', 'exception', 'exit'])
+
+        self.failUnlessRaises(ValueError, CLAHookTest.add_hook,
+                              'unknown', base_callback)
+        self.failIf([ e for e in CommandLineApp._get_hooks().values() if e ])
+        return
+
+    def test_tracing(self):
+        class CLATracingTest(CommandLineApp):
+            force_exit = False
+            _app_name = 'cla-tracing'
+            _app_version = '1.0'
+            def option_handler_t(self):
+                pass
+            def main(self, *args):
+                if args == ('fail',):
+                    raise RuntimeError('failed')
+                return 0
+            def handle_main_exception(self, err):
+                return 1
+
+        class Exporter(object):
+            def export(self, app, spans):
+                self.spans = spans
+
+        CLATracingTest.trace_exporter = exporter = Exporter()
+        CLATracingTest(['-t', 'a']).run()
+        names = [ s.name for s in exporter.spans ]
+        self.failUnlessEqual(names, ['parse_options', 'option',
+                                     'validate_arguments', 'main', 'run'])
+        root = exporter.spans[-1]
+        self.failUnlessEqual(root.attributes['app.name'], 'cla-tracing')
+        self.failUnlessEqual(root.attributes['process.exit_code'], 0)
+        for span in exporter.spans[:-1]:
+            self.failUnlessEqual(span.parent_span_id, root.span_id)
+            self.failUnlessEqual(span.trace_id, root.trace_id)
+            self.failUnless(root.start_time <= span.start_time <= span.end_time
+                            <= root.end_time)
+
+        CLATracingTest(['fail']).run()
+        self.failUnlessEqual([ (s.name, s.error) for s in exporter.spans ],
+                             [ ('parse_options', None),
+                               ('validate_arguments', None),
+                               ('main', 'failed'),
+                               ('run', 'Exit code 1'),
+                               ])
+
+        # Options that cannot be parsed still finish the trace and run
+        # the exit hooks.
+        exit_codes = []
+        CLATracingTest.add_hook('exit',
+                                lambda app, exit_code: exit_codes.append(exit_code))
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            app = CLATracingTest(['--bogus'])
+            self.assertRaises(getopt.error, app.run)
+        finally:
+            sys.stdout = stdout
+        self.failUnlessEqual([ (s.name, s.error) for s in exporter.spans ],
+                             [ ('parse_options', 'Invalid options'),
+                               ('run', 'Exit code 1'),
+                               ])
+        self.failUnlessEqual(exit_codes, [1])
+        return
+
+    def test_trace_file(self):
+        class CLATraceFileTest(CommandLineApp):
+            force_exit = False
+            _app_name = 'cla-trace-file'
+
+        trace_dir = tempfile.mkdtemp()
+        trace_filename = os.path.join(trace_dir, 'trace.jsonl')
+        os.environ['COMMANDLINEAPP_TRACE_FILE'] = trace_filename
+        os.environ['TRACEPARENT'] = '00-%s-%s-01' % ('1' * 32, '2' * 16)
+        try:
+            CLATraceFileTest([]).run()
+            CLATraceFileTest([]).run()
+            import json
+            lines = open(trace_filename).read().splitlines()
+            self.failUnlessEqual(len(lines), 2)
+            request = json.loads(lines[0])
+            resource_spans = request['resourceSpans'][0]
+            self.failUnlessEqual(resource_spans['resource']['attributes'],
+                                 [{'key': 'service.name',
+                                   'value': {'stringValue': 'cla-trace-file'}}])
+            spans = resource_spans['scopeSpans'][0]['spans']
+            root = spans[-1]
+            self.failUnlessEqual(root['name'], 'run')
+            self.failUnlessEqual(root['traceId'], '1' * 32)
+            self.failUnlessEqual(root['parentSpanId'], '2' * 16)
+            self.failUnless({'key': 'process.exit_code',
+                             'value': {'intValue': '0'}} in root['attributes'])
+        finally:
+            del os.environ['COMMANDLINEAPP_TRACE_FILE']
+            del os.environ['TRACEPARENT']
+            shutil.rmtree(trace_dir)
+        return
+
+    def test_cancel_signal(self):
+        class CLACancelSignalTest(CommandLineApp):
+            force_exit = False
+            CANCEL_SIGNALS = ('SIGTERM', 'SIGHUP')
+            handled = False
+            def handle_sigterm(self):
+                self.handled = True
+            def main(self, *args):
+                os.kill(os.getpid(), signal.SIGTERM)
+                for i in range(100):
+                    if self.cancelled:
+                        return 5
+                    time.sleep(0.01)
+                return 0
+
+        original_handler = signal.getsignal(signal.SIGTERM)
+        app = CLACancelSignalTest([])
+        self.failUnlessEqual(app.run(), 5)
+        self.failUnless(app.handled)
+        self.failUnlessEqual(app.cancel_signal, signal.SIGTERM)
+        self.failUnlessEqual(signal.getsignal(signal.SIGTERM), original_handler)
+
+        # Signals are only handled by apps that ask for them.
+        class CLANoCancelSignalTest(CommandLineApp):
+            force_exit = False
+            def main(self):
+                return signal.getsignal(signal.SIGTERM)
+        self.failUnlessEqual(CLANoCancelSignalTest([]).run(), original_handler)
+        return
+
+    def test_cancel_signal_deadline(self):
+        class CLACancelDeadlineTest(CommandLineApp):
+            force_exit = False
+            CANCEL_SIGNALS = ('SIGTERM', 'SIGHUP')
+            shutdown_grace_period = 0.05
+            interrupted = False
+            def handle_interrupt(self):
+                self.interrupted = True
+                return 7
+            def main(self, *args):
+                os.kill(os.getpid(), signal.SIGHUP)
+                time.sleep(5)
+                return 0
+
+        app = CLACancelDeadlineTest([])
+        start = time.time()
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            exit_code = app.run()
+            error_output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.failUnlessEqual(exit_code, 128 + signal.SIGHUP)
+        self.failUnless(time.time() - start < 1)
+        self.failIf(app.interrupted)
+        self.failUnless('Did not stop within 0.05 seconds' in error_output,
+                        error_output)
+        self.failUnlessEqual(signal.getsignal(signal.SIGALRM), signal.SIG_DFL)
+        return
+
+    def test_input_records(self):
+        import bz2
+        import gzip
+        tempdir = tempfile.mkdtemp()
+        try:
+            data = 'one\ntwo\nthree'
+            plain = os.path.join(tempdir, 'plain.txt')
+            f = open(plain, 'wb')
+            f.write(data)
+            f.close()
+            compressed = os.path.join(tempdir, 'compressed.gz')
+            f = gzip.GzipFile(compressed, 'wb')
+            f.write(data)
+            f.close()
+            bzipped = os.path.join(tempdir, 'compressed.bz2')
+            f = bz2.BZ2File(bzipped, 'wb')
+            f.write(data)
+            f.close()
+            empty = os.path.join(tempdir, 'empty.txt')
+            open(empty, 'wb').close()
+
+            app = CommandLineApp([])
+            app.INPUT_BUFFER_SIZE = 4
+            expected = ['one\n', 'two\n', 'three']
+            for filename in (plain, compressed, bzipped):
+                records = list(app.iter_input_records([filename]))
+                self.failUnlessEqual(records, expected)
+            records = list(app.iter_input_records([plain, empty, compressed]))
+            self.failUnlessEqual(records, expected + expected)
+            chunks = list(app.iter_input_chunks([plain], chunk_size=5))
+            self.failUnlessEqual(chunks, ['one\nt', 'wo\nth', 'ree'])
+
+            stdin = sys.stdin
+            sys.stdin = StringIO('a,b,c')
+            try:
+                records = list(app.iter_input_records(separator=','))
+            finally:
+                sys.stdin = stdin
+            self.failUnlessEqual(records, ['a,', 'b,', 'c'])
+
+            # Compressed standard input is decompressed too.
+            for filename in (compressed, bzipped):
+                sys.stdin = StringIO(open(filename, 'rb').read())
+                try:
+                    records = list(app.iter_input_records(['-']))
+                    self.failIf(sys.stdin.closed)
+                finally:
+                    sys.stdin = stdin
+                self.failUnlessEqual(records, expected)
+
+            # Named pipes cannot be rewound after checking for compression.
+            fifo = os.path.join(tempdir, 'fifo')
+            os.mkfifo(fifo)
+            def write_fifo(contents):
+                f = open(fifo, 'wb')
+                f.write(contents)
+                f.close()
+            for filename in (plain, compressed, bzipped):
+                writer = threading.Thread(target=write_fifo,
+                                          args=(open(filename, 'rb').read(),))
+                writer.start()
+                f = app.open_input(fifo)
+                try:
+                    self.failUnlessEqual(f.readline(), 'one\n')
+                    self.failUnlessEqual(list(f), ['two\n', 'three'])
+                finally:
+                    f.close()
+                writer.join()
+            writer = threading.Thread(target=write_fifo, args=(data,))
+            writer.start()
+            records = list(app.iter_input_records([fifo]))
+            writer.join()
+            self.failUnlessEqual(records, expected)
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
+    def test_output_file(self):
+        import gzip
+        class CLAOutputTest(CommandLineApp):
+            force_exit = False
+            def main(self, text, exit_code):
+                self.get_output().write(text)
+                if exit_code == 'error':
+                    raise ValueError('failed')
+                return int(exit_code)
+
+        tempdir = tempfile.mkdtemp()
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            filename = os.path.join(tempdir, 'output.txt')
+            exit_code = CLAOutputTest(['--output', filename,
+                                       'first', '0']).run()
+            self.failUnlessEqual(exit_code, 0)
+            self.failUnlessEqual(open(filename).read(), 'first')
+            for exit_code in ('1', 'error'):
+                CLAOutputTest(['--output', filename, 'second',
+                               exit_code]).run()
+                self.failUnlessEqual(open(filename).read(), 'first')
+            self.failUnlessEqual(os.listdir(tempdir), ['output.txt'])
+
+            # The permissions of the file being replaced are kept.
+            os.chmod(filename, 0600)
+            CLAOutputTest(['--output', filename, 'first', '0']).run()
+            self.failUnlessEqual(os.stat(filename).st_mode & 0777, 0600)
+
+            compressed = os.path.join(tempdir, 'output.txt.gz')
+            CLAOutputTest(['--output', compressed, 'third', '0']).run()
+            self.failUnlessEqual(gzip.GzipFile(compressed).read(), 'third')
+
+            # The file is not replaced when main() does not run.
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                exit_code = CLAOutputTest(['--output', filename, '-h']).run()
+            finally:
+                sys.stdout = stdout
+            self.failUnlessEqual(exit_code, 0)
+            self.failUnlessEqual(open(filename).read(), 'first')
+        finally:
+            sys.stderr = stderr
+            shutil.rmtree(tempdir)
+        return
+
+    def test_output_file_cached(self):
+        class CLAOutputCacheTest(CommandLineApp):
+            force_exit = False
+            cache_results = True
+            calls = 0
+            def main(self):
+                CLAOutputCacheTest.calls += 1
+                self.get_output().write('report data\n')
+                print 'done'
+                return 0
+
+        tempdir = tempfile.mkdtemp()
+        original_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = tempdir
+        stdout = sys.stdout
+        try:
+            filename = os.path.join(tempdir, 'out.txt')
+            for i in range(2):
+                if os.path.exists(filename):
+                    os.unlink(filename)
+                sys.stdout = buffer = StringIO()
+                try:
+                    exit_code = CLAOutputCacheTest(['--output', filename]).run()
+                finally:
+                    sys.stdout = stdout
+                self.failUnlessEqual(exit_code, 0)
+                self.failUnlessEqual(buffer.getvalue(), '')
+                self.failUnlessEqual(open(filename).read(),
+                                     'report data\ndone\n')
+            self.failUnlessEqual(CLAOutputCacheTest.calls, 1)
+        finally:
+            if original_cache_home is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = original_cache_home
+            shutil.rmtree(tempdir)
+        return
+
+    def test_output_file_jobs(self):
+        class CLAOutputJobsTest(CommandLineApp):
+            force_exit = False
+            def main_item(self, arg):
+                time.sleep(0.01 * (4 - int(arg)))
+                print 'item', arg
+                self.get_output().write('written %s\n' % arg)
+                return 0
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'out.txt')
+            args = ['--jobs=3', '--output', filename, '1', '2', '3', '4']
+            for processes in (False, True):
+                CLAOutputJobsTest.fan_out_processes = processes
+                CLAOutputJobsTest.preserve_output_order = True
+                self.failUnlessEqual(CLAOutputJobsTest(args).run(), 0)
+                self.failUnlessEqual(open(filename).read(), ''.join([
+                            'item %d\nwritten %d\n' % (i, i)
+                            for i in range(1, 5) ]))
+                CLAOutputJobsTest.preserve_output_order = False
+                self.failUnlessEqual(CLAOutputJobsTest(args).run(), 0)
+                self.failUnlessEqual(
+                    sorted(open(filename).read().split('item ')),
+                    [''] + [ '%d\nwritten %d\n' % (i, i) for i in range(1, 5) ])
+                self.failUnlessEqual(os.listdir(tempdir), ['out.txt'])
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
+    def test_csvcat_example(self):
+        import imp
+        csvcat = imp.load_source(
+            'csvcat', os.path.join(os.path.dirname(__file__) or '.',
+                                   'examples', 'csvcat.py'))
+        tempdir = tempfile.mkdtemp()
+        try:
+            filenames = []
+            for i in range(3):
+                filename = os.path.join(tempdir, 'input%d.csv' % i)
+                f = open(filename, 'wb')
+                f.write('a,b,c\r\n%d,"x, %d",y\r\n' % (i, i))
+                f.close()
+                filenames.append(filename)
+            output = os.path.join(tempdir, 'output.csv')
+            def run_csvcat(args):
+                app = csvcat.csvcat(['--skip-headers', '--output', output] +
+                                    args + filenames)
+                app.force_exit = False
+                app.run()
+                return open(output).read()
+            for options in ([], ['--jobs', '2']):
+                self.failUnlessEqual(
+                    run_csvcat(options),
+                    'a,b,c\r\n0,"x, 0",y\r\n1,"x, 1",y\r\n2,"x, 2",y\r\n')
+                self.failUnlessEqual(
+                    run_csvcat(['--columns', '2,1'] + options),
+                    'c,b\r\ny,"x, 0"\r\ny,"x, 1"\r\ny,"x, 2"\r\n')
+
+            # Copied files keep their line endings, and rows are not
+            # joined when a file does not end with a newline.
+            for i, contents in enumerate(['h1,h2\n1,2', 'h1,h2\n3,4\n',
+                                          'h1,h2\r\n5,6']):
+                f = open(filenames[i], 'wb')
+                f.write(contents)
+                f.close()
+            self.failUnlessEqual(run_csvcat([]),
+                                 'h1,h2\n1,2\n3,4\n5,6\r\n')
+            self.failUnlessEqual(run_csvcat(['--columns', '1,0']),
+                                 'h2,h1\r\n2,1\r\n4,3\r\n6,5\r\n')
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
+    def test_sqlite_app(self):
+        class CLASQLiteTest(commandlineapp.SQLiteAppBase):
+            force_exit = False
+            PRAGMAS = (('cache_size', 123),)
+            def take_action(self):
+                self.connections.append(self.db_connection)
+                if self.action == 'insert':
+                    self.cursor.execute('CREATE TABLE log (message text)')
+                    self.count = self.insert_many(
+                        'INSERT INTO log VALUES (?)',
+                        ((str(i),) for i in range(5)), batch_size=2)
+                elif self.action == 'fail':
+                    self.cursor.execute("INSERT INTO log VALUES ('lost')")
+                    raise ValueError('failed')
+                else:
+                    self.cache_size = self.cursor.execute(
+                        'PRAGMA cache_size').fetchone()[0]
+                    self.rows = list(self.iter_rows(
+                        'SELECT * FROM log', batch_size=2))
+                    self.write_rows('SELECT * FROM log WHERE message < ?',
+                                    ('2',), '<%s>')
+                return 0
+
+        tempdir = tempfile.mkdtemp()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = output = StringIO()
+        sys.stderr = StringIO()
+        try:
+            db = os.path.join(tempdir, 'test.db')
+            CLASQLiteTest.connections = []
+            for action in ('insert', 'fail', 'show'):
+                app = CLASQLiteTest(['--db', db])
+                app.action = action
+                app.run()
+                if action == 'insert':
+                    self.failUnlessEqual(app.count, 5)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            CLASQLiteTest.close_connections()
+            shutil.rmtree(tempdir)
+        self.failUnlessEqual(app.cache_size, 123)
+        self.failUnlessEqual(app.rows, [ (unicode(i),) for i in range(5) ])
+        self.failUnlessEqual(output.getvalue(), '<0>\n<1>\n')
+        connections = CLASQLiteTest.connections
+        self.failUnlessEqual(len(connections), 3)
+        self.failUnless(connections[0] is connections[1] is connections[2])
+        return
+
+    def test_sqlite_substring_search(self):
+        class CLASQLiteSearchTest(commandlineapp.SQLiteAppBase):
+            force_exit = False
+            reuse_connections = False
+            def take_action(self):
+                self.cursor.execute('CREATE TABLE log (message text)')
+                self.insert_many('INSERT INTO log VALUES (?)',
+                                 [('Created database',), ('100% done',)])
+                self.results = [self.search('TABLE'), self.search('%')]
+                self.create_text_index('log', 'message')
+                self.cursor.execute(
+                    "INSERT INTO log VALUES ('Created log table')")
+                self.results.extend([self.search('TABLE'),
+                                     self.search('"'),
+                                     self.search('ta')])
+                return 0
+            def search(self, substring):
+                where, parameters = self.get_substring_filter(
+                    'log', 'message', substring)
+                return [ row[0] for row in self.cursor.execute(
+                        'SELECT message FROM log WHERE ' + where, parameters) ]
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            app = CLASQLiteSearchTest(['--db', os.path.join(tempdir, 'test.db')])
+            self.failUnlessEqual(app.run(), 0)
+        finally:
+            shutil.rmtree(tempdir)
+        self.failUnlessEqual(app.results, [
+                [],
+                [u'100% done'],
+                [u'Created log table'],
+                [],
+                [u'Created database', u'Created log table'],
+                ])
+        return
+
+    def test_declared_options(self):
+        from commandlineapp import Option
+        class CLADeclaredTest(CommandLineApp):
+            force_exit = False
+            SCAN_OPTION_HANDLERS = False
+            limit = Option('limit', aliases=['l'], type=int, default=10,
+                           arg_name='num', help='Show at most num items.')
+            dry_run = Option('dry-run', help='Do not change anything.')
+            include = Option('include', type=str, is_variable=True)
+            tags = Option('tag', handler='add_tags', arg_name='name')
+            def add_tags(self, name):
+                self.added = name
+                return
+            def option_handler_ignored(self):
+                "Not found, since handlers are not scanned."
+                return
+            def main(self):
+                return
+
+        app = CLADeclaredTest([])
+        switches = [ o.switch for o in app.supported_options ]
+        self.failUnless('--ignored' not in switches)
+        self.failUnless('--help' in switches)
+        self.failUnlessEqual([ s for s in switches
+                               if s in ('--dry-run', '--include', '-l',
+                                        '--limit', '--tag') ],
+                             ['--dry-run', '--include', '-l', '--limit', '--tag'])
+        self.failUnlessEqual(app.limit, 10)
+        self.failUnlessEqual(app.dry_run, None)
+        app.run()
+        self.failUnlessEqual(app.limit, 10)
+
+        app = CLADeclaredTest(['-l', '5', '--dry-run', '--include=a,b',
+                               '--tag', 'x'])
+        app.run()
+        self.failUnlessEqual(app.limit, 5)
+        self.failUnlessEqual(app.dry_run, True)
+        self.failUnlessEqual(app.include, ['a', 'b'])
+        self.failUnlessEqual(app.added, 'x')
+        self.failUnlessEqual(CLADeclaredTest.limit.default, 10)
+
+        help_text = app.get_verbose_syntax_help_string()
+        self.failUnless('    -l num, --limit=num\n'
+                        '        Show at most num items.\n' in help_text,
+                        help_text)
+
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            exit_code = CLADeclaredTest(['--limit', 'many']).run()
+            error = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.failUnlessEqual(exit_code, 1)
+        self.failUnless("Invalid value for --limit: 'many'" in error, error)
+        return
+
+    def test_option_constraints(self):
+        from commandlineapp import Option, option_constraints
+        class CLAConstraintTest(CommandLineApp):
+            force_exit = False
+            EXCLUSIVE_OPTION_GROUPS = (('json', 'csv'),)
+            format = Option('format', choices=('short', 'long'), arg_name='name')
+            retries = Option('retries', type=int, min_value=0, max_value=5)
+            json = Option('json')
+            csv = Option('csv', conflicts=['--dry-run'])
+            @option_constraints(required=True)
+            def option_handler_name(self, name):
+                self.name = name
+                return
+            option_handler_n = option_handler_name
+            @option_constraints(requires=['name'], min_value=1)
+            def option_handler_dry_run(self, level=1):
+                self.handled = True
+                return
+            handled = False
+            def main(self):
+                self.main_called = True
+                return
+            main_called = False
+
+        def run(args):
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                app = CLAConstraintTest(args)
+                exit_code = app.run()
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            return app, exit_code, output
+
+        app, exit_code, output = run(['-n', 'x', '--format', 'long',
+                                      '--retries', '5', '--json'])
+        self.failUnlessEqual(exit_code, None)
+        self.failUnless(app.main_called)
+
+        app, exit_code, output = run(['--format=wide', '--retries=9',
+                                      '--json', '--csv', '--dry-run=0'])
+        self.failUnlessEqual(exit_code, 1)
+        self.failIf(app.main_called or app.handled)
+        for message in ["--format must be one of short, long, not 'wide'",
+                        "--retries must be at most 5, not 9",
+                        "--dry-run must be at least 1, not '0'",
+                        "--csv cannot be used with --dry-run",
+                        "--dry-run requires --name",
+                        "--name is required",
+                        "Only one of --json, --csv can be used",
+                        ]:
+            self.failUnless(message in output, (message, output))
+
+        # Asking for help does not require the other options.
+        for switch in ('-h', '--help'):
+            app, exit_code, output = run([switch, '--json', '--csv'])
+            self.failUnlessEqual(exit_code, 0)
+            self.failIf('ERROR' in output, output)
+            self.failUnless('--name=name' in output, output)
+        self.assertRaises(TypeError, option_constraints, needed=True)
+        return
+
+    def test_accumulate_options(self):
+        from commandlineapp import Option, accumulate_option
+        class CLAAccumulateTest(CommandLineApp):
+            force_exit = False
+            calls = 0
+            @accumulate_option()
+            def option_handler_include(self, *pattern):
+                self.calls += 1
+                self.include = pattern
+                return
+            @accumulate_option('append')
+            def option_handler_exclude(self, patterns):
+                self.exclude = patterns
+                return
+            debug_level = Option('d', accumulate='count')
+            sizes = Option('size', type=int, is_variable=True,
+                           accumulate='append')
+            ports = Option('port', type=int, accumulate='append')
+            def main(self):
+                return
+
+        args = ['-v', '--include=a,b', '-d', '-v', '--exclude', 'x']
+        for i in range(1000):
+            args.extend(['--include', str(i)])
+        args.extend(['-d', '--size=1,2', '--exclude=y', '-v', '--size=3',
+                     '--port=1', '--port=2'])
+        app = CLAAccumulateTest(args)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            app.run()
+        finally:
+            sys.stdout = stdout
+        self.failUnlessEqual(app.verbose_level, 4)
+        self.failUnlessEqual(app.calls, 1)
+        self.failUnlessEqual(app.include,
+                             ('a', 'b') + tuple([ str(i) for i in range(1000) ]))
+        self.failUnlessEqual(app.exclude, ['x', 'y'])
+        self.failUnlessEqual(app.debug_level, 2)
+        self.failUnlessEqual(app.sizes, [1, 2, 3])
+        self.failUnlessEqual(app.ports, [1, 2])
+        self.assertRaises(ValueError, accumulate_option, 'sum')
+
+        # -v is not accumulated, so it still works with --quiet in order.
+        app = CLAAccumulateTest(['-v', '--quiet', '-v'])
+        app.run()
+        self.failUnlessEqual(app.verbose_level, 1)
+        return
+
+    def test_option_invokers(self):
+        class CLAInvokerTest(CommandLineApp):
+            force_exit = False
+            def option_handler_name(self, name):
+                self.name = name
+                return
+            def option_handler_flag(self):
+                self.flag = True
+                return
+            def option_handler_items(self, *item):
+                self.items = item
+                return
+            def main(self):
+                return
+
+        app = CLAInvokerTest(['--name=a', '--flag', '--items=b,c'])
+        options = dict([ (o.option_name, o) for o in app.supported_options ])
+        invoker = app._get_option_invoker(options['name'])
+        self.failUnlessEqual(invoker, app.option_handler_name)
+        self.failUnless(app._get_option_invoker(options['name']) is invoker)
+        app.run()
+        self.failUnlessEqual(app.name, 'a')
+        self.failUnlessEqual(app.flag, True)
+        self.failUnlessEqual(app.items, ('b', 'c'))
+        options['items'].invoke(app, 'd')
+        self.failUnlessEqual(app.items, ('d',))
+        return
+
+    def test_render_help(self):
+        class CLARenderTest(CommandLineApp):
+            """Render the help.
+
+            Uses <markup> & -dashes.
+            """
+            _app_name = 'cla-render'
+            EXAMPLES_DESCRIPTION = '''
+  $ cla-render --name x file
+'''
+            def before_options_hook(self):
+                raise AssertionError('the app should not be created')
+            def option_handler_name(self, name):
+                "Set the *name*."
+                return
+            option_handler_n = option_handler_name
+            def main(self, filename):
+                """filename - The file to read."""
+                return
+
+        man = CLARenderTest.render_help('man')
+        self.failUnless(man.startswith('.TH CLA\\-RENDER 1 "" "cla\\-render"\n'
+                                       '.SH NAME\n'
+                                       'cla\\-render \\- Render the help.\n'
+                                       '.SH SYNOPSIS\n'
+                                       '.B cla\\-render\n'
+                                       '[options] filename\n'), man)
+        self.failUnless('.TP\n.B \\-n name, \\-\\-name=name\nSet the *name*.\n'
+                        in man, man)
+        self.failUnless('.nf\n  $ cla\\-render \\-\\-name x file\n.fi\n' in man,
+                        man)
+
+        markdown = CLARenderTest.render_help('markdown')
+        self.failUnless('# cla-render\n\nRender the help.\n\n'
+                        'Uses \\<markup\\> & -dashes.\n\n'
+                        '## Synopsis\n\n    cla-render [options] filename\n'
+                        in markdown, markdown)
+        self.failUnless('### `-n name`, `--name=name`\n\nSet the \\*name\\*.\n'
+                        in markdown, markdown)
+
+        html = CLARenderTest.render_help('html')
+        self.failUnless('<p>Uses &lt;markup&gt; &amp; -dashes.</p>' in html, html)
+        self.failUnless('<p>filename - The file to read.</p>' in html, html)
+        self.failUnless('<dt><code>-n name</code>, <code>--name=name</code></dt>'
+                        in html, html)
+        self.assertRaises(ValueError, CLARenderTest.render_help, 'pdf')
+
+        tempdir = tempfile.mkdtemp()
+        try:
+            filenames = commandlineapp.write_help_files(
+                [CLARenderTest, 'commandlineapp:SQLiteAppBase'], 'markdown',
+                os.path.join(tempdir, 'help'))
+            self.failUnlessEqual(
+                [ os.path.basename(f) for f in filenames ],
+                ['cla-render.md', 'SQLiteAppBase.md'])
+            self.failUnlessEqual(open(filenames[0]).read(), markdown)
+        finally:
+            shutil.rmtree(tempdir)
+        return
+
+    def test_progress(self):
+        class CLAProgressTest(CommandLineApp):
+            force_exit = False
+            _app_name = 'cla-progress'
+            PROGRESS_LOG_INTERVAL = 0.01
+            def main(self, *args):
+                progress = self.start_progress(total=4)
+                for i in range(4):
+                    progress.count += 1
+                    time.sleep(0.02)
+                progress.finish()
+                self.progress = progress
+                return 0
+
+        stderr = sys.stderr
+        sys.stderr = buffer = StringIO()
+        try:
+            app = CLAProgressTest([])
+            app.run()
+            quiet_app = CLAProgressTest(['--quiet'])
+            quiet_app.run()
+        finally:
+            sys.stderr = stderr
+        lines = buffer.getvalue().splitlines()
+        self.failUnless(len(lines) > 1)
+        self.failUnless(lines[-1].startswith('cla-progress: 4/4 (100.0%) '),
+                        lines[-1])
+        self.failUnless(lines[-1].endswith('/s ETA 0:00:00'), lines[-1])
+        self.failUnlessEqual(quiet_app.progress.count, 4)
+        return
+
+    def test_progress_status_text(self):
+        progress = commandlineapp.Progress(label='items')
+        progress.count = 10
+        self.failUnless(progress.get_status_text().startswith('items: 10 '))
+        progress.finish()
+        return
+
     def test_format_help_text_none(self):
         class CLAFormatHelpTextNone(CommandLineApp):
             force_exit = False
@@ -345,8 +1825,11 @@ class CLATestCase(unittest.TestCase):
     --debug
     -h
     --help
+    --output=filename
     --quiet
     --repeats=arg[,arg...]
+    --stats
+    --stats-json
     -v
     --verbose=level
 ''')
@@ -382,7 +1865,10 @@ SYNTAX:
     --debug
     -h
     --help
+    --output=filename
     --quiet
+    --stats
+    --stats-json
     -v
     --verbose=level
 
@@ -405,9 +1891,19 @@ OPTIONS:
     --help
         Displays verbose help message.
 
+    --output=filename
+        Write output to filename, replacing it only if the program
+        succeeds.  Names ending in .gz, .bz2, or .xz are compressed.
+
     --quiet
         Turn on quiet mode.
 
+    --stats
+        Report resource usage when the program exits.
+
+    --stats-json
+        Report resource usage as JSON when the program exits.
+
     -v
         Increment the verbose level.
 